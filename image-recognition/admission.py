@@ -0,0 +1,102 @@
+"""
+Admission control for the image recognition API.
+
+Bursts are limited in three places, so tail latency stays predictable under overload:
+    - every API token gets a token bucket of requests per second with a burst allowance,
+    - at most `max_in_flight` requests run at once and at most `max_queue` wait for a slot,
+      anything beyond that is rejected right away with a Retry-After estimate,
+    - every request carries a deadline, waiting for a slot and model work stop once it passes.
+
+Classes:
+    DeadlineExceeded: Raised when a request runs out of time.
+    Rejected: Raised when the queue is full, carries the suggested Retry-After in seconds.
+    Admission: Bounded set of running and queued requests.
+    RateLimiter: Token buckets keyed by API token.
+"""
+import math
+import threading
+import time
+
+
+class DeadlineExceeded(Exception):
+    def __init__(self, message="Deadline exceeded"):
+        super().__init__(message)
+
+
+class Rejected(Exception):
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Admission:
+    def __init__(self, max_in_flight=4, max_queue=16):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.condition = threading.Condition()
+        self.running = 0
+        self.waiting = 0
+        self.rejected = 0
+        # Moving average of how long a request holds its slot, used for Retry-After
+        self.service_time = 1.0
+
+    def retry_after(self):
+        return max(1, math.ceil(self.service_time * (self.waiting + 1) / self.max_in_flight))
+
+    def acquire(self, deadline):
+        with self.condition:
+            if self.running >= self.max_in_flight and self.waiting >= self.max_queue:
+                self.rejected += 1
+                raise Rejected("Too many requests, the queue is full", self.retry_after())
+
+            self.waiting += 1
+            try:
+                while self.running >= self.max_in_flight:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise DeadlineExceeded("Deadline exceeded while queued")
+                    self.condition.wait(remaining)
+            finally:
+                self.waiting -= 1
+            self.running += 1
+        return time.monotonic()
+
+    def release(self, acquired):
+        with self.condition:
+            self.running -= 1
+            self.service_time = 0.9 * self.service_time + 0.1 * (time.monotonic() - acquired)
+            self.condition.notify()
+
+    def stats(self):
+        with self.condition:
+            return {
+                "running": self.running,
+                "waiting": self.waiting,
+                "max_in_flight": self.max_in_flight,
+                "max_queue": self.max_queue,
+                "rejected": self.rejected,
+                "service_time": self.service_time,
+            }
+
+
+class RateLimiter:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.lock = threading.Lock()
+        self.buckets = {}
+
+    def check(self, key):
+        """Takes one token from the bucket of `key`, returns 0 or the seconds until one is available."""
+        if self.rate <= 0:
+            return 0
+
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens >= 1:
+                self.buckets[key] = (tokens - 1, now)
+                return 0
+            self.buckets[key] = (tokens, now)
+            return (1 - tokens) / self.rate
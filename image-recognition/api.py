@@ -5,29 +5,111 @@ This module sets up a Flask web server that accepts POST requests with an image
 It uses a pre-trained language model to process the image and generate an answer to the question.
 
 Environment Variables:
-- API_TOKEN: The token required to authorize API requests.
+- API_TOKEN: The token required to authorize API requests, or several comma separated tokens.
+- MOONDREAM_QUANTIZE: Set to "int8" to run the linear layers with dynamic int8 quantization on CPU.
+- MOONDREAM_REVISION: Model revision loaded at startup (default 2024-08-26).
+- MOONDREAM_SNAPSHOT: Local snapshot directory of the model (default: resolved from the local
+  Hugging Face cache, see loader.py). No hub revision lookups are made at startup either way.
+- ADMIN_TOKEN: Token for the /admin routes, they are disabled when it is not set.
+- ENCODING_CACHE_MB: Memory budget of the image encoding cache in megabytes (default 512).
+- ENCODING_CACHE_DIR: Optional directory for the on-disk tier of the image encoding cache.
+- BATCH_MAX_SIZE: Maximum number of concurrent requests run as one model batch (default 8).
+- BATCH_WAIT_MS: How long the first request of a batch waits for others to join (default 10).
+- IMAGE_MAX_BYTES, IMAGE_MAX_PIXELS, IMAGE_MAX_SIDE: Upload limits and resize target, see preprocess.py.
+- ANSWER_CACHE_SIZE: Maximum number of cached answers (default 10000, 0 disables the cache).
+- ANSWER_CACHE_TTL: Seconds a cached answer stays valid (default 3600).
+- PHASH_MAX_DISTANCE: Uploads whose perceptual hashes are within this many bits of an image seen
+  before, with the same aspect ratio, reuse its cached encoding and answers (default -1, disabled).
+  Flat images such as blank frames are never matched, and /classify never uses near-duplicates.
+- MAX_IN_FLIGHT: Model requests processed at once (default 4). Answers served from the answer cache
+  do not take a slot.
+- MAX_QUEUE: Model requests waiting for a slot before new ones are rejected with 429 (default 16).
+- MAX_QUESTIONS: Questions accepted by one /questions request (default 16). They all run under the
+  request's single admission slot, so more are rejected with 400.
+- REQUEST_TIMEOUT: Default deadline of a model request in seconds (default 60).
+- REQUEST_TIMEOUT_MAX: Upper bound for the X-Request-Timeout header (default 300).
+- RATE_LIMIT_RPS, RATE_LIMIT_BURST: Requests per second and burst allowed per API token
+  (default 0, no limit, and 10).
 
 Routes:
 - POST /: Processes the image and answers the question.
+- POST /questions: Encodes the image once and answers every question in the list.
+- POST /stream: Same as POST /, but sends the answer as server-sent events while it is decoded.
+- POST /classify: Answers a closed question with one of a fixed set of labels (yes/no by default)
+  from the next-token logits of a single forward pass, with the probability of every label (every
+  casing of a label counts, "Yes" for "yes") and label_mass, the share of the next-token
+  distribution the labels cover.
+- GET /health: Liveness probe, 200 as soon as the server accepts requests, 500 once loading or
+  warming up the model failed, so the process gets restarted.
+- GET /ready: Readiness probe, 503 until the model is loaded and warmed up, then 200.
+  Both probes need no token and report the startup time breakdown (import, weight load, warmup).
+- POST /admin/revision: Loads the model revision from the "revision" form field in the background,
+  warms it up and switches new requests to it. The previous model finishes its in-flight requests
+  and is freed afterwards. Requires ADMIN_TOKEN. Under serve.py the parent loads the revision and
+  replaces the workers one at a time instead, each old worker finishing its requests first.
+- GET /admin/revision: Current revision and the state of the last swap, including the memory
+  overhead while both models were resident.
+- GET /stats: Returns image encoding cache, answer cache and batching statistics.
+- GET /metrics: Prometheus metrics: per-stage latency histograms (upload read, image decode,
+  encode_image, answer_question), request latency, queue depth, in-flight requests,
+  cache hit ratio and process RSS.
 
 Request Headers:
 - Authorization: Bearer token for API authorization.
+- Cache-Control: "no-cache" bypasses the answer cache for the request.
+- X-Request-Timeout: Optional deadline of the request in seconds. Waiting in the queue and text
+  generation stop once it passes and the request fails with 504.
 
 Request Form Data:
 - image_file: The image file to be processed.
 - question_string: The question string to be answered.
+- questions: For /questions, the questions to be answered, either repeated form fields or one JSON array.
+- cache: Optional, "0" bypasses the answer cache for the request (fresh answers are still stored).
+- labels: For /classify, optional labels, at least two, either repeated form fields or one JSON array
+  (default yes and no).
 
 Response:
 - JSON object containing the question and the generated answer, or an error message.
+- "cached" is true when the answer came from the answer cache.
+- Uploads above the byte or pixel limits are rejected with status 413, bodies above the byte limit
+  plus 1 MB before they are read.
+- When the queue is full or the token exceeds its rate limit, status 429 with a Retry-After header.
+- For /questions, a JSON object with the list of question and answer pairs.
+- For /classify, a JSON object with the question, the most likely label and the label probabilities.
+- For /stream, a text/event-stream with "token" events carrying text pieces and a final "done"
+  event with the full answer, time to first token and total time in seconds (or an "error" event).
+
+Startup:
+- The server starts accepting requests right away. The model is loaded and warmed up with a
+  synthetic encode and answer in a background thread, model routes answer 503 until then.
+- Entry points: `python api.py` and serve.py call start() themselves. Under any other WSGI server
+  (`flask --app api run`, `gunicorn api:app`) the first request of a process starts the loading,
+  so point the readiness probe at /ready to get it going.
 
 Raises:
 - ValueError: If API_TOKEN is not set in the .env file.
 """
+import time
+process_started = time.perf_counter()
+
+import json
 import os
-from flask import Flask, request, jsonify
-from transformers import AutoModelForCausalLM, AutoTokenizer
+import struct
+import threading
+import traceback
+from flask import Flask, Response, g, request, jsonify, stream_with_context
 from PIL import Image
 from dotenv import load_dotenv
+from loader import ModelHandle, load_model
+from cache import AnswerCache, EncodingCache, image_key
+from admission import Admission, DeadlineExceeded, RateLimiter, Rejected
+from batcher import MicroBatcher
+from inference import encode_images, answer_questions, stream_answer, classify, label_token_ids
+from preprocess import MAX_BYTES, ImageRejected, load_image
+from phash import PerceptualIndex, dhash, vertical_dhash
+import metrics
+
+startup = {"import_seconds": time.perf_counter() - process_started}
 
 # Load environment variables
 load_dotenv()
@@ -36,23 +118,358 @@ API_TOKEN = os.getenv("API_TOKEN")
 if not API_TOKEN:
     raise ValueError("API_TOKEN is not set in the .env file")
 
-# Initialize model and tokenizer
+API_TOKENS = {token.strip() for token in API_TOKEN.split(",") if token.strip()}
+
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+# Current model and tokenizer, set by load() and replaced by swap_revision(). Every request
+# pins the handle it started with, so encoding and answering always use the same model.
 model_id = "vikhyatk/moondream2"
-revision = "2024-08-26"
-model = AutoModelForCausalLM.from_pretrained(
-    model_id, trust_remote_code=True, revision=revision
+revision = os.getenv("MOONDREAM_REVISION", "2024-08-26")
+current = None
+current_lock = threading.Lock()
+ready = threading.Event()
+startup_thread = None
+startup_lock = threading.Lock()
+swap_status = {"state": "idle"}
+swap_lock = threading.Lock()
+# Set by serve.py: swaps requested on a worker are handed to the parent, which reloads every worker
+swap_hook = None
+
+# Cache image encodings so repeat questions about the same image skip the encoder
+encoding_cache = EncodingCache(
+    max_bytes=int(os.getenv("ENCODING_CACHE_MB", "512")) * 1024 * 1024,
+    disk_dir=os.getenv("ENCODING_CACHE_DIR"),
+)
+
+# Cache whole answers, they are deterministic for a given image and question
+answer_cache = AnswerCache(
+    max_entries=int(os.getenv("ANSWER_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("ANSWER_CACHE_TTL", "3600")),
+)
+
+# Map resized or re-encoded copies of an image to the cache key of the first copy seen. A match
+# reuses answers, so it is off by default and confirmed by the aspect ratio and a second hash.
+phash_max_distance = int(os.getenv("PHASH_MAX_DISTANCE", "-1"))
+# Index payload: cache key, width, height and vertical hash of the first copy
+PHASH_PAYLOAD = struct.Struct("<32sIIQ")
+# Flat images hash to (nearly) all zero bits and would match each other
+PHASH_MIN_BITS = 8
+PHASH_MAX_ASPECT_DIFFERENCE = 0.02
+phash_index = (
+    PerceptualIndex(phash_max_distance, payload_size=PHASH_PAYLOAD.size) if phash_max_distance >= 0 else None
 )
-tokenizer = AutoTokenizer.from_pretrained(model_id, revision=revision)
+
+# Batch concurrent requests in front of the vision encoder and the text decoder
+batch_max_size = int(os.getenv("BATCH_MAX_SIZE", "8"))
+batch_wait_ms = float(os.getenv("BATCH_WAIT_MS", "10"))
+
+def per_model(run):
+    # Items start with the model handle of their request. During a revision swap a batch can hold
+    # items of both models, so run every model's share separately and keep the original order.
+    def batch(items):
+        groups = {}
+        for position, (handle, *args) in enumerate(items):
+            groups.setdefault(handle, []).append((position, args))
+
+        results = [None] * len(items)
+        for handle, group in groups.items():
+            for (position, _), result in zip(group, run(handle, [args for _, args in group])):
+                results[position] = result
+        return results
+
+    return batch
+
+def encode_batch(handle, items):
+    return encode_images(handle.model, [image for image, in items])
+
+encode_batcher = MicroBatcher(
+    per_model(encode_batch), max_batch_size=batch_max_size, max_wait_ms=batch_wait_ms, name="encode-batcher",
+)
+
+def answer_batch(handle, items):
+    enc_images, questions, deadlines = zip(*items)
+    return answer_questions(handle.model, handle.tokenizer, enc_images, questions, deadlines=deadlines)
+
+answer_batcher = MicroBatcher(
+    per_model(answer_batch), max_batch_size=batch_max_size, max_wait_ms=batch_wait_ms, name="answer-batcher",
+)
+
+def classify_batch(handle, items):
+    enc_images, questions, label_sets = zip(*items)
+    return classify(handle.model, handle.tokenizer, enc_images, questions, label_sets)
+
+classify_batcher = MicroBatcher(
+    per_model(classify_batch), max_batch_size=batch_max_size, max_wait_ms=batch_wait_ms, name="classify-batcher",
+)
+
+# Bound the work in progress and give every request a deadline
+admission = Admission(
+    max_in_flight=int(os.getenv("MAX_IN_FLIGHT", "4")),
+    max_queue=int(os.getenv("MAX_QUEUE", "16")),
+)
+rate_limiter = RateLimiter(
+    rate=float(os.getenv("RATE_LIMIT_RPS", "0")),
+    burst=float(os.getenv("RATE_LIMIT_BURST", "10")),
+)
+max_questions = int(os.getenv("MAX_QUESTIONS", "16"))
+request_timeout = float(os.getenv("REQUEST_TIMEOUT", "60"))
+request_timeout_max = float(os.getenv("REQUEST_TIMEOUT_MAX", "300"))
+MODEL_ENDPOINTS = {"process_image", "process_questions", "process_image_stream", "classify_image"}
+
+# Metrics
+STAGE_SECONDS = metrics.Histogram(
+    "moondream_stage_seconds", "Latency of each stage of a request", label="stage"
+)
+REQUEST_SECONDS = metrics.Histogram(
+    "moondream_request_seconds", "Latency of whole requests", label="endpoint"
+)
+FIRST_TOKEN_SECONDS = metrics.Histogram(
+    "moondream_time_to_first_token_seconds", "Time to the first streamed token"
+)
+IN_FLIGHT = metrics.Gauge("moondream_in_flight_requests", "Requests being processed")
+NEAR_DUPLICATES = metrics.Gauge(
+    "moondream_near_duplicates_total", "Uploads mapped to a perceptually identical image", kind="counter"
+)
+metrics.Gauge(
+    "moondream_queue_depth", "Items waiting for a model batch",
+    fn=lambda: {
+        "encode_image": encode_batcher.queue.qsize(),
+        "answer_question": answer_batcher.queue.qsize(),
+        "classify": classify_batcher.queue.qsize(),
+    },
+    label="queue",
+)
+metrics.Gauge(
+    "moondream_admission", "Model requests by admission state",
+    fn=lambda: {state: admission.stats()[state] for state in ("running", "waiting", "rejected")},
+    label="state",
+)
+metrics.Gauge(
+    "moondream_encoding_cache_hit_ratio", "Share of image encoding cache lookups that hit",
+    fn=lambda: encoding_cache.stats()["hit_ratio"],
+)
+metrics.Gauge(
+    "moondream_encoding_cache_lookups_total", "Image encoding cache lookups by result",
+    fn=lambda: {result: encoding_cache.stats()[result] for result in ("hits", "disk_hits", "misses")},
+    label="result", kind="counter",
+)
+metrics.Gauge(
+    "moondream_answer_cache_hit_ratio", "Share of answer cache lookups that hit",
+    fn=lambda: answer_cache.stats()["hit_ratio"],
+)
+metrics.Gauge("process_resident_memory_bytes", "Resident memory size in bytes", fn=metrics.process_rss)
+metrics.Gauge(
+    "moondream_startup_seconds", "Duration of each startup phase",
+    fn=lambda: {phase[:-len("_seconds")]: value for phase, value in startup.items() if phase.endswith("_seconds")},
+    label="phase",
+)
+metrics.Gauge("moondream_ready", "1 once the model is loaded and warmed up", fn=lambda: int(ready.is_set()))
+metrics.Gauge(
+    "moondream_model_info", "Revision of the model serving new requests",
+    fn=lambda: {revision: 1}, label="revision",
+)
+
+def load(new_revision=None):
+    global current, revision
+    started = time.perf_counter()
+    # The snapshot is pinned to the startup revision, a new one comes from the cache like in swap_revision
+    snapshot = os.getenv("MOONDREAM_SNAPSHOT") if new_revision is None else None
+    target = revision if new_revision is None else new_revision
+    model, tokenizer = load_model(
+        model_id, target,
+        quantize=os.getenv("MOONDREAM_QUANTIZE"), snapshot=snapshot,
+    )
+    # Only switch once the load succeeded, a failed swap keeps reporting the revision still served
+    current = ModelHandle(model, tokenizer, target)
+    revision = target
+    startup["weight_load_seconds"] = time.perf_counter() - started
+
+def warmup(handle):
+    # Run the encoder and a few decode steps once so the first real request does not pay for
+    # lazy kernel and tokenizer initialization
+    image = Image.new("RGB", (378, 378), (127, 127, 127))
+    enc_images = encode_images(handle.model, [image])
+    answer_questions(handle.model, handle.tokenizer, enc_images, ["Describe this image."], max_new_tokens=8)
+
+def start(load_weights=True, exit_on_failure=False):
+    """Loads and warms up the model in a background thread, once per process."""
+    global startup_thread
+
+    def run():
+        try:
+            if load_weights:
+                load()
+            started = time.perf_counter()
+            warmup(current)
+        except Exception as e:
+            # Without this the thread dies silently and the process stays alive but never ready
+            startup["error"] = repr(e)
+            traceback.print_exc()
+            if exit_on_failure:
+                os._exit(1)
+            return
+        startup["warmup_seconds"] = time.perf_counter() - started
+        startup["ready_seconds"] = time.perf_counter() - process_started
+        ready.set()
+        print(f"Ready in {startup['ready_seconds']:.1f}s: {startup}", flush=True)
+
+    with startup_lock:
+        if startup_thread is None:
+            startup_thread = threading.Thread(target=run, name="startup", daemon=True)
+            startup_thread.start()
+    return startup_thread
 
 # Create Flask app
 app = Flask(__name__)
+# Refuse oversized bodies before they are parsed, the form fields besides the image get 1 MB
+app.config["MAX_CONTENT_LENGTH"] = MAX_BYTES + 1024 * 1024
+
+@app.before_request
+def start_request():
+    # WSGI servers import the app without calling start(), the first request does it for them
+    if startup_thread is None:
+        start()
+    g.started = time.perf_counter()
+    IN_FLIGHT.inc()
+
+    if request.endpoint in MODEL_ENDPOINTS:
+        return admit()
+
+@app.errorhandler(413)
+def request_too_large(e):
+    return jsonify({"error": f"Request is larger than {app.config['MAX_CONTENT_LENGTH']} bytes"}), 413
+
+@app.teardown_request
+def finish_request(exc):
+    IN_FLIGHT.dec()
+    REQUEST_SECONDS.observe(time.perf_counter() - g.started, request.endpoint)
+    if g.get("admitted") is not None:
+        admission.release(g.admitted)
+    if g.get("handle") is not None:
+        g.handle.release()
+
+def admit():
+    # Unauthorized requests and requests during startup are answered by the route itself
+    if not is_authorized() or not ready.is_set():
+        return None
+
+    try:
+        timeout = min(float(request.headers.get("X-Request-Timeout", request_timeout)), request_timeout_max)
+    except ValueError:
+        return jsonify({"error": "X-Request-Timeout must be a number of seconds"}), 400
+    g.deadline = time.monotonic() + timeout
+
+    retry_after = rate_limiter.check(bearer_token())
+    if retry_after:
+        return jsonify({"error": "Rate limit exceeded"}), 429, {"Retry-After": str(max(1, round(retry_after)))}
+
+    with current_lock:
+        g.handle = current.acquire()
+    return None
+
+def take_slot():
+    # Taken just before the model runs, so cache hits never wait behind slow generations
+    if g.get("admitted") is None:
+        g.admitted = admission.acquire(g.deadline)
+
+def rejected(e):
+    return jsonify({"error": str(e)}), 429, {"Retry-After": str(e.retry_after)}
+
+def not_ready():
+    return jsonify({"error": "Model is loading"}), 503, {"Retry-After": "5"}
+
+def bearer_token():
+    token = request.headers.get("Authorization")
+    return token.split(" ")[-1] if token else None
+
+def is_authorized():
+    return bearer_token() in API_TOKENS
+
+def read_upload(image_file):
+    with STAGE_SECONDS.time("upload_read"):
+        # One byte over the limit is enough to reject it, the rest is never read into memory
+        data = image_file.read(MAX_BYTES + 1)
+    if len(data) > MAX_BYTES:
+        raise ImageRejected(f"Image is larger than {MAX_BYTES} bytes")
+    return data, image_key(data)
+
+def decode_upload(data):
+    with STAGE_SECONDS.time("image_decode"):
+        return load_image(data)
+
+def resolve_upload(data, key):
+    # Returns the cache key of a near-duplicate seen before (or the upload's own key)
+    # and the decoded image if it had to be decoded for hashing
+    if phash_index is None or revision_key(key) in encoding_cache:
+        return key, None
+
+    image = decode_upload(data)
+    image_hash, image_vertical_hash = dhash(image), vertical_dhash(image)
+    if image_hash.bit_count() + image_vertical_hash.bit_count() < PHASH_MIN_BITS:
+        return key, image
+
+    match = phash_index.nearest(image_hash)
+    if match is not None:
+        match_key, width, height, vertical_hash = PHASH_PAYLOAD.unpack(match[0])
+        aspect_difference = abs(image.width * height - width * image.height) / (width * image.height)
+        if (
+            aspect_difference <= PHASH_MAX_ASPECT_DIFFERENCE
+            and (vertical_hash ^ image_vertical_hash).bit_count() <= phash_max_distance
+        ):
+            NEAR_DUPLICATES.inc()
+            return match_key.hex(), image
+
+    phash_index.add(image_hash, PHASH_PAYLOAD.pack(bytes.fromhex(key), image.width, image.height, image_vertical_hash))
+    return key, image
+
+def encode_upload(data, key, image=None):
+    def encode():
+        decoded = image if image is not None else decode_upload(data)
+        with STAGE_SECONDS.time("encode_image"):
+            return encode_batcher((g.handle, decoded), g.deadline)
+
+    # Load and process the image, reusing the encoding of identical uploads
+    return encoding_cache.get_or_encode(revision_key(key), encode)
+
+def answer_image_question(enc_image, question):
+    with STAGE_SECONDS.time("answer_question"):
+        answer = answer_batcher((g.handle, enc_image, question, g.deadline), g.deadline)
+    if answer is None:
+        raise DeadlineExceeded()
+    return answer
+
+def use_answer_cache():
+    return request.form.get("cache") != "0" and "no-cache" not in request.headers.get("Cache-Control", "")
+
+def cached_answer(key, question):
+    return answer_cache.get(revision_key(key), question) if use_answer_cache() else None
+
+def revision_key(key):
+    # Encodings and answers of one revision are not valid for another
+    return f"{key}.{g.handle.revision}"
+
+def form_list(field):
+    values = request.form.getlist(field)
+    if len(values) == 1 and values[0].lstrip().startswith("["):
+        try:
+            values = json.loads(values[0])
+        except ValueError:
+            raise ValueError(f"'{field}' is not a valid JSON list")
+    if not isinstance(values, list) or not all(isinstance(value, str) for value in values):
+        raise ValueError(f"'{field}' must be a list of strings")
+    return [value for value in values if value.strip()]
+
+def form_questions():
+    return form_list("questions")
 
 @app.route("/", methods=["POST"])
 def process_image():
     # Check API token
-    token = request.headers.get("Authorization")
-    if not token or token.split(" ")[-1] != API_TOKEN:
+    if not is_authorized():
         return jsonify({"error": "Unauthorized"}), 401
+    if not ready.is_set():
+        return not_ready()
 
     # Check form data
     if "image_file" not in request.files or "question_string" not in request.form:
@@ -62,17 +479,322 @@ def process_image():
     question_string = request.form["question_string"]
 
     try:
-        # Load and process the image
-        image = Image.open(image_file)
-        enc_image = model.encode_image(image)
+        data, key = read_upload(image_file)
+        answer = cached_answer(key, question_string)
+        if answer is None:
+            near_key, image = resolve_upload(data, key)
+            if near_key != key:
+                key = near_key
+                answer = cached_answer(key, question_string)
+        if answer is not None:
+            return jsonify({"question": question_string, "answer": answer, "cached": True}), 200
+
+        take_slot()
+        enc_image = encode_upload(data, key, image)
 
         # Generate the answer
-        answer = model.answer_question(enc_image, question_string, tokenizer)
-        return jsonify({"question": question_string, "answer": answer}), 200
+        answer = answer_image_question(enc_image, question_string)
+        answer_cache.put(revision_key(key), question_string, answer)
+        return jsonify({"question": question_string, "answer": answer, "cached": False}), 200
+    except ImageRejected as e:
+        return jsonify({"error": str(e)}), 413
+    except Rejected as e:
+        return rejected(e)
+    except DeadlineExceeded as e:
+        return jsonify({"error": str(e)}), 504
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/questions", methods=["POST"])
+def process_questions():
+    # Check API token
+    if not is_authorized():
+        return jsonify({"error": "Unauthorized"}), 401
+    if not ready.is_set():
+        return not_ready()
+
+    # Check form data
+    if "image_file" not in request.files or "questions" not in request.form:
+        return jsonify({"error": "Both 'image_file' and 'questions' are required"}), 400
+
+    try:
+        questions = form_questions()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if not questions:
+        return jsonify({"error": "'questions' must contain at least one question"}), 400
+    if len(questions) > max_questions:
+        return jsonify({"error": f"'questions' may contain at most {max_questions} questions"}), 400
+
+    try:
+        data, key = read_upload(request.files["image_file"])
+        cached = {question: cached_answer(key, question) for question in questions}
+        missing = [question for question in questions if cached[question] is None]
+
+        image = None
+        if missing:
+            near_key, image = resolve_upload(data, key)
+            if near_key != key:
+                key = near_key
+                cached.update({question: cached_answer(key, question) for question in missing})
+                missing = [question for question in missing if cached[question] is None]
+
+        futures = {}
+        if missing:
+            take_slot()
+            enc_image = encode_upload(data, key, image)
+
+            # Submit every question at once so they share batches of the text decoder
+            submitted = time.perf_counter()
+            futures = {
+                question: answer_batcher.submit((g.handle, enc_image, question, g.deadline), g.deadline)
+                for question in missing
+            }
+
+        answers = []
+        for question in questions:
+            if question in futures:
+                answer = futures[question].result()
+                if answer is None:
+                    raise DeadlineExceeded()
+                STAGE_SECONDS.observe(time.perf_counter() - submitted, "answer_question")
+                answer_cache.put(revision_key(key), question, answer)
+                answers.append({"question": question, "answer": answer, "cached": False})
+            else:
+                answers.append({"question": question, "answer": cached[question], "cached": True})
+        return jsonify({"answers": answers}), 200
+    except ImageRejected as e:
+        return jsonify({"error": str(e)}), 413
+    except Rejected as e:
+        return rejected(e)
+    except DeadlineExceeded as e:
+        return jsonify({"error": str(e)}), 504
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/classify", methods=["POST"])
+def classify_image():
+    # Check API token
+    if not is_authorized():
+        return jsonify({"error": "Unauthorized"}), 401
+    if not ready.is_set():
+        return not_ready()
+
+    # Check form data
+    if "image_file" not in request.files or "question_string" not in request.form:
+        return jsonify({"error": "Both 'image_file' and 'question_string' are required"}), 400
+
+    question_string = request.form["question_string"]
+    try:
+        labels = form_list("labels") or ["yes", "no"]
+        # Checked here, an error inside the batch would fail every request batched with this one
+        label_token_ids(g.handle.tokenizer, labels)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        data, key = read_upload(request.files["image_file"])
+        # No near-duplicate lookup, a verdict must come from this image and not from a similar one
+        take_slot()
+        enc_image = encode_upload(data, key)
+
+        with STAGE_SECONDS.time("classify"):
+            result = classify_batcher((g.handle, enc_image, question_string, labels), g.deadline)
+        return jsonify({"question": question_string, **result}), 200
+    except ImageRejected as e:
+        return jsonify({"error": str(e)}), 413
+    except Rejected as e:
+        return rejected(e)
+    except DeadlineExceeded as e:
+        return jsonify({"error": str(e)}), 504
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+def sse(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+@app.route("/stream", methods=["POST"])
+def process_image_stream():
+    # Check API token
+    if not is_authorized():
+        return jsonify({"error": "Unauthorized"}), 401
+    if not ready.is_set():
+        return not_ready()
+
+    # Check form data
+    if "image_file" not in request.files or "question_string" not in request.form:
+        return jsonify({"error": "Both 'image_file' and 'question_string' are required"}), 400
+
+    image_file = request.files["image_file"]
+    question_string = request.form["question_string"]
+    started = time.perf_counter()
+    deadline = g.deadline
+    handle = g.handle
+
+    try:
+        data, key = read_upload(image_file)
+        answer = cached_answer(key, question_string)
+        enc_image = None
+        if answer is None:
+            near_key, image = resolve_upload(data, key)
+            if near_key != key:
+                key = near_key
+                answer = cached_answer(key, question_string)
+            if answer is None:
+                take_slot()
+                enc_image = encode_upload(data, key, image)
+    except ImageRejected as e:
+        return jsonify({"error": str(e)}), 413
+    except Rejected as e:
+        return rejected(e)
+    except DeadlineExceeded as e:
+        return jsonify({"error": str(e)}), 504
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+    def events():
+        if answer is not None:
+            yield sse("token", {"text": answer})
+            yield sse("done", {
+                "question": question_string,
+                "answer": answer,
+                "cached": True,
+                "time_to_first_token": time.perf_counter() - started,
+                "total_time": time.perf_counter() - started,
+            })
+            return
+
+        first_token = None
+        pieces = []
+        answer_started = time.perf_counter()
+        try:
+            for text in stream_answer(handle.model, handle.tokenizer, enc_image, question_string, deadline=deadline):
+                if first_token is None:
+                    first_token = time.perf_counter() - started
+                    FIRST_TOKEN_SECONDS.observe(first_token)
+                pieces.append(text)
+                yield sse("token", {"text": text})
+        except Exception as e:
+            yield sse("error", {"error": str(e)})
+            return
+
+        STAGE_SECONDS.observe(time.perf_counter() - answer_started, "answer_question")
+        full_answer = "".join(pieces).strip()
+        answer_cache.put(revision_key(key), question_string, full_answer)
+        yield sse("done", {
+            "question": question_string,
+            "answer": full_answer,
+            "cached": False,
+            "time_to_first_token": first_token,
+            "total_time": time.perf_counter() - started,
+        })
+
+    return Response(
+        stream_with_context(events()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+def swap_revision(new_revision):
+    global current, revision
+    try:
+        swap_status.update({"state": "loading", "revision": new_revision, "started": time.time()})
+        rss_before = metrics.process_rss()
+        started = time.perf_counter()
+        model, tokenizer = load_model(model_id, new_revision, quantize=os.getenv("MOONDREAM_QUANTIZE"))
+        handle = ModelHandle(model, tokenizer, new_revision)
+        swap_status["load_seconds"] = time.perf_counter() - started
+
+        swap_status["state"] = "warming"
+        started = time.perf_counter()
+        warmup(handle)
+        swap_status["warmup_seconds"] = time.perf_counter() - started
+
+        rss_both = metrics.process_rss()
+        swap_status.update({"rss_before": rss_before, "rss_both_resident": rss_both, "overhead_bytes": rss_both - rss_before})
+
+        with current_lock:
+            old = current
+            current = handle
+            revision = new_revision
+        swap_status.update({"state": "draining", "previous_revision": old.revision, "in_flight": old.refs})
+
+        def freed(handle):
+            swap_status.update({"state": "done", "rss_after": metrics.process_rss(), "finished": time.time()})
+            print(f"Switched to revision {new_revision}, revision {handle.revision} freed", flush=True)
+
+        old.retire(freed)
+    except Exception as e:
+        swap_status.update({"state": "failed", "error": str(e)})
+
+@app.route("/admin/revision", methods=["GET", "POST"])
+def admin_revision():
+    if not ADMIN_TOKEN:
+        return jsonify({"error": "ADMIN_TOKEN is not set"}), 403
+    if bearer_token() != ADMIN_TOKEN:
+        return jsonify({"error": "Unauthorized"}), 401
+
+    if request.method == "GET":
+        return jsonify({"revision": revision, "swap": swap_hook.status() if swap_hook else swap_status}), 200
+
+    if not ready.is_set():
+        return not_ready()
+    if "revision" not in request.form:
+        return jsonify({"error": "'revision' is required"}), 400
+
+    new_revision = request.form["revision"]
+    if swap_hook is not None:
+        if not swap_hook.request(new_revision):
+            return jsonify({"error": "A revision swap is already in progress", "swap": swap_hook.status()}), 409
+        return jsonify({"revision": revision, "swap": {"state": "requested", "revision": new_revision}}), 202
+
+    # Check and claim under one lock, otherwise two concurrent requests could both start a load
+    with swap_lock:
+        if swap_status["state"] in ("loading", "warming", "draining"):
+            return jsonify({"error": "A revision swap is already in progress", "swap": swap_status}), 409
+        swap_status.clear()
+        swap_status.update({"state": "loading", "revision": new_revision})
+    threading.Thread(target=swap_revision, args=(new_revision,), name="swap", daemon=True).start()
+    return jsonify({"revision": revision, "swap": swap_status}), 202
+
+@app.route("/health", methods=["GET"])
+def health():
+    if "error" in startup:
+        return jsonify({"status": "failed", "ready": False, "revision": revision, "startup": startup}), 500
+    return jsonify({"status": "ok", "ready": ready.is_set(), "revision": revision, "startup": startup}), 200
+
+@app.route("/ready", methods=["GET"])
+def readiness():
+    if not ready.is_set():
+        return jsonify({"status": "loading", "startup": startup}), 503
+    return jsonify({"status": "ready", "startup": startup}), 200
+
+@app.route("/stats", methods=["GET"])
+def stats():
+    if not is_authorized():
+        return jsonify({"error": "Unauthorized"}), 401
+
+    return jsonify({
+        "encoding_cache": encoding_cache.stats(),
+        "answer_cache": answer_cache.stats(),
+        "phash_index": {"entries": len(phash_index) if phash_index is not None else 0, "near_duplicates": NEAR_DUPLICATES.value},
+        "encode_batcher": encode_batcher.stats(),
+        "answer_batcher": answer_batcher.stats(),
+        "classify_batcher": classify_batcher.stats(),
+        "admission": admission.stats(),
+    }), 200
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    if not is_authorized():
+        return jsonify({"error": "Unauthorized"}), 401
+
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
 # Run the app
 if __name__ == "__main__":
+    start()
     app.run(host="0.0.0.0", port=5000)
 
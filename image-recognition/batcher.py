@@ -0,0 +1,96 @@
+"""
+Dynamic micro-batching for model calls made from concurrent request threads.
+
+Each request thread submits one item and blocks on a future. A single worker thread collects
+the items that arrive within `max_wait_ms` of the first one, up to `max_batch_size`, runs the
+batch function once and hands every result back to its caller. The extra latency a request can
+pay for batching is bounded by the wait window.
+
+Items submitted with a deadline that passes while they wait are failed with DeadlineExceeded
+instead of being run.
+
+Threads do not survive fork, so a forked worker process (see serve.py) starts its own queue
+and batching thread.
+
+Classes:
+    MicroBatcher: Collects items into batches for a function that maps a list of inputs to a list of outputs.
+"""
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from admission import DeadlineExceeded
+
+
+class MicroBatcher:
+    def __init__(self, fn, max_batch_size=8, max_wait_ms=10, name="batcher"):
+        self.fn = fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.name = name
+        self.start()
+        os.register_at_fork(after_in_child=self.start)
+
+    def start(self):
+        self.queue = queue.Queue()
+        self.batches = 0
+        self.items = 0
+        self.thread = threading.Thread(target=self.run, name=self.name, daemon=True)
+        self.thread.start()
+
+    def submit(self, item, deadline=None):
+        future = Future()
+        self.queue.put((item, future, deadline))
+        return future
+
+    def __call__(self, item, deadline=None):
+        return self.submit(item, deadline).result()
+
+    def collect(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = []
+            collected = self.collect()
+            # collect() blocks while the queue is idle, read the clock once it returns
+            now = time.monotonic()
+            for item, future, deadline in collected:
+                if deadline is not None and deadline <= now:
+                    future.set_exception(DeadlineExceeded())
+                else:
+                    batch.append((item, future))
+            if not batch:
+                continue
+
+            try:
+                results = self.fn([item for item, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            self.batches += 1
+            self.items += len(batch)
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+    def stats(self):
+        return {
+            "queue_depth": self.queue.qsize(),
+            "batches": self.batches,
+            "items": self.items,
+            "mean_batch_size": self.items / self.batches if self.batches else 0.0,
+        }
@@ -0,0 +1,63 @@
+"""
+Benchmark of the preprocessing stage over the sample images in this folder.
+
+For every image the script compares the plain path used before (`Image.open` followed by a
+full decode to RGB) with `preprocess.load_image`, and reports the median decode time and the
+size of the decoded pixel buffer, which dominates peak memory per request.
+
+Usage:
+    python bench_preprocess.py --repeat 20
+"""
+import argparse
+import glob
+import io
+import os
+import statistics
+import time
+
+from PIL import Image
+
+from preprocess import load_image
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def full_decode(data):
+    image = Image.open(io.BytesIO(data))
+    return image.convert("RGB")
+
+
+def measure(decode, data, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        image = decode(data)
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings), image
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark image preprocessing")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    paths = sorted(glob.glob(os.path.join(HERE, "*.jpg")) + glob.glob(os.path.join(HERE, "*.png")))
+    print(f"{'image':<8} {'size KB':>8} {'full ms':>8} {'fast ms':>8} {'speedup':>8} {'full px':>11} {'fast px':>9} {'full MB':>8} {'fast MB':>8}")
+    for path in paths:
+        with open(path, "rb") as file:
+            data = file.read()
+
+        full_time, full_image = measure(full_decode, data, args.repeat)
+        fast_time, fast_image = measure(load_image, data, args.repeat)
+        full_mb = full_image.width * full_image.height * 3 / 1024 / 1024
+        fast_mb = fast_image.width * fast_image.height * 3 / 1024 / 1024
+
+        print(
+            f"{os.path.basename(path):<8} {len(data) / 1024:>8.0f} {full_time * 1000:>8.1f} {fast_time * 1000:>8.1f} "
+            f"{full_time / fast_time:>7.1f}x {f'{full_image.width}x{full_image.height}':>11} "
+            f"{f'{fast_image.width}x{fast_image.height}':>9} {full_mb:>8.1f} {fast_mb:>8.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+Benchmark of full precision against dynamic int8 quantized moondream2 on CPU.
+
+Every mode runs in its own process so the memory numbers are not mixed up. For every sample
+image in this folder the script times `encode_image` and `answer_question` (median of the
+repeats after one warmup run) and keeps the answers. The report compares latency, RSS after
+loading and after inference, and how well the int8 answers agree with the full precision ones:
+exact matches and the mean text similarity ratio.
+
+Usage:
+    python bench_quantize.py --repeat 3 --output quantize.json
+"""
+import argparse
+import difflib
+import glob
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+QUESTIONS = ["Describe this image.", "Does this image contains sexual context?"]
+
+
+def rss_mb(field="VmRSS"):
+    with open("/proc/self/status") as file:
+        for line in file:
+            if line.startswith(f"{field}:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def run_mode(mode, repeat, threads):
+    import torch
+    from PIL import Image
+    from loader import load_model
+
+    torch.set_num_threads(threads)
+    started = time.perf_counter()
+    model, tokenizer = load_model("vikhyatk/moondream2", "2024-08-26", quantize=None if mode == "fp32" else mode)
+    result = {"mode": mode, "load_seconds": time.perf_counter() - started, "rss_loaded_mb": rss_mb(), "images": {}}
+
+    paths = sorted(glob.glob(os.path.join(HERE, "*.jpg")) + glob.glob(os.path.join(HERE, "*.png")))
+    for path in paths:
+        image = Image.open(path)
+        encode_times = []
+        answer_times = []
+        answers = {}
+        for i in range(repeat + 1):
+            start = time.perf_counter()
+            enc_image = model.encode_image(image)
+            encode_time = time.perf_counter() - start
+            for question in QUESTIONS:
+                start = time.perf_counter()
+                answers[question] = model.answer_question(enc_image, question, tokenizer)
+                if i:
+                    answer_times.append(time.perf_counter() - start)
+            if i:
+                encode_times.append(encode_time)
+
+        result["images"][os.path.basename(path)] = {
+            "encode_seconds": statistics.median(encode_times),
+            "answer_seconds": statistics.median(answer_times),
+            "answers": answers,
+        }
+
+    result["rss_peak_mb"] = rss_mb("VmHWM")
+    return result
+
+
+def compare(baseline, candidate):
+    similarities = []
+    exact = 0
+    for name, image in baseline["images"].items():
+        for question, answer in image["answers"].items():
+            other = candidate["images"][name]["answers"][question]
+            exact += answer == other
+            similarities.append(difflib.SequenceMatcher(None, answer, other).ratio())
+    return {"exact_match": exact / len(similarities), "mean_similarity": statistics.mean(similarities)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare full precision and int8 moondream2 on CPU")
+    parser.add_argument("--modes", default="fp32,int8")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--threads", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--output", help="Write all results to this JSON file")
+    parser.add_argument("--run-mode", help=argparse.SUPPRESS)
+    parser.add_argument("--result-file", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_mode:
+        with open(args.result_file, "w") as file:
+            json.dump(run_mode(args.run_mode, args.repeat, args.threads), file)
+        return
+
+    results = []
+    for mode in args.modes.split(","):
+        with tempfile.NamedTemporaryFile(suffix=".json") as result_file:
+            subprocess.check_call(
+                [sys.executable, __file__, "--run-mode", mode, "--result-file", result_file.name,
+                 "--repeat", str(args.repeat), "--threads", str(args.threads)],
+                cwd=HERE,
+            )
+            results.append(json.load(result_file))
+
+    baseline = results[0]
+    print(f"{'mode':<6} {'load s':>7} {'RSS MB':>8} {'peak MB':>8} {'encode s':>9} {'answer s':>9} {'exact':>6} {'similar':>8}")
+    for result in results:
+        images = result["images"].values()
+        agreement = compare(baseline, result)
+        result["agreement"] = agreement
+        print(
+            f"{result['mode']:<6} {result['load_seconds']:>7.1f} {result['rss_loaded_mb']:>8.0f} {result['rss_peak_mb']:>8.0f} "
+            f"{statistics.mean(image['encode_seconds'] for image in images):>9.2f} "
+            f"{statistics.mean(image['answer_seconds'] for image in images):>9.2f} "
+            f"{agreement['exact_match']:>6.0%} {agreement['mean_similarity']:>8.2f}"
+        )
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+"""
+Benchmark of the pre-fork server: requests per second and memory as the worker count grows.
+
+For every worker count the script starts serve.py, waits until its workers report ready, sends
+requests with the sample images from this folder from several client threads for a fixed time,
+and samples the memory of the parent and all workers.
+
+RSS counts the shared weight pages once per process, so the sum over processes overstates the
+real footprint. PSS splits shared pages between the processes that map them and is the number
+to compare across worker counts.
+
+Usage:
+    python bench_workers.py --workers 1,2,4 --duration 60 --concurrency 8
+
+Output:
+    A table with workers, requests per second, p50/p99 latency, summed RSS and summed PSS.
+"""
+import argparse
+import glob
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import requests
+from dotenv import load_dotenv
+
+load_dotenv()
+API_TOKEN = os.getenv("API_TOKEN")
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+IMAGES = sorted(glob.glob(os.path.join(HERE, "*.jpg")) + glob.glob(os.path.join(HERE, "*.png")))
+
+
+def wait_until_ready(port, process, workers, timeout):
+    # Every probe lands on whichever worker accepts it, so wait for a run of successes
+    deadline = time.monotonic() + timeout
+    successes = 0
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"serve.py exited with status {process.returncode}")
+        try:
+            ok = requests.get(f"http://127.0.0.1:{port}/ready", timeout=5).ok
+        except requests.RequestException:
+            ok = False
+        successes = successes + 1 if ok else 0
+        if successes >= workers * 4:
+            return
+        time.sleep(0.1 if ok else 1)
+    raise TimeoutError(f"Server was not ready within {timeout} seconds")
+
+
+def process_tree(pid):
+    pids = [pid]
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as file:
+            for child in file.read().split():
+                pids.extend(process_tree(int(child)))
+    except OSError:
+        pass
+    return pids
+
+
+def memory_kb(pid, field):
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as file:
+            for line in file:
+                if line.startswith(f"{field}:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run_clients(port, duration, concurrency, question):
+    url = f"http://127.0.0.1:{port}/"
+    headers = {"Authorization": f"Bearer {API_TOKEN}"}
+    payloads = []
+    for path in IMAGES:
+        with open(path, "rb") as file:
+            payloads.append((os.path.basename(path), file.read()))
+
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    stop_at = time.monotonic() + duration
+
+    def client(offset):
+        session = requests.Session()
+        i = offset
+        while time.monotonic() < stop_at:
+            name, data = payloads[i % len(payloads)]
+            i += 1
+            start = time.perf_counter()
+            response = session.post(
+                url, headers=headers,
+                files={"image_file": (name, data)}, data={"question_string": question},
+            )
+            elapsed = time.perf_counter() - start
+            with lock:
+                (latencies if response.ok else errors).append(elapsed)
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors
+
+
+def bench(workers, args):
+    # Turn off every cache so each request runs the model
+    env = dict(
+        os.environ, ENCODING_CACHE_MB="0", ENCODING_CACHE_DIR="", ANSWER_CACHE_SIZE="0", PHASH_MAX_DISTANCE="-1"
+    )
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, "serve.py"), "--workers", str(workers), "--port", str(args.port)],
+        cwd=HERE, env=env, stdout=subprocess.DEVNULL,
+    )
+    try:
+        wait_until_ready(args.port, process, workers, args.startup_timeout)
+        latencies, errors = run_clients(args.port, args.duration, args.concurrency, args.question)
+        pids = process_tree(process.pid)
+        rss = sum(memory_kb(pid, "Rss") for pid in pids)
+        pss = sum(memory_kb(pid, "Pss") for pid in pids)
+    finally:
+        process.terminate()
+        process.wait()
+
+    return {
+        "workers": workers,
+        "rps": len(latencies) / args.duration,
+        "p50": percentile(latencies, 0.5),
+        "p99": percentile(latencies, 0.99),
+        "errors": len(errors),
+        "rss_mb": rss / 1024,
+        "pss_mb": pss / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark serve.py with a growing number of workers")
+    parser.add_argument("--workers", default="1,2,4")
+    parser.add_argument("--duration", type=float, default=60)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--port", type=int, default=5055)
+    parser.add_argument("--startup-timeout", type=float, default=600)
+    parser.add_argument("--question", default="Describe this image.")
+    args = parser.parse_args()
+
+    print(f"{'workers':>7} {'req/s':>8} {'p50 s':>8} {'p99 s':>8} {'errors':>6} {'RSS MB':>9} {'PSS MB':>9}")
+    for workers in [int(value) for value in args.workers.split(",")]:
+        result = bench(workers, args)
+        print(
+            f"{result['workers']:>7} {result['rps']:>8.2f} {result['p50']:>8.2f} {result['p99']:>8.2f} "
+            f"{result['errors']:>6} {result['rss_mb']:>9.0f} {result['pss_mb']:>9.0f}",
+            flush=True,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+"""
+Caches of moondream2 image encodings and answers keyed by a hash of the uploaded image bytes.
+
+Encoding the image is the expensive part of a request, while clients often ask several
+questions about the same picture. The encoding cache lets repeat requests skip the vision
+encoder, and the answer cache lets repeat questions skip the model completely.
+
+Encoding cache tiers:
+    memory: LRU dictionary bounded by the total size of the stored tensors in bytes.
+    disk: Optional directory with one torch file per encoding, used when the memory tier misses.
+
+Classes:
+    EncodingCache: Two-tier cache with hit/miss counters.
+    AnswerCache: LRU cache of answers keyed by (image hash, normalized question) with a TTL.
+
+Functions:
+    image_key(data): Returns the content hash used as the cache key.
+    normalize_question(question): Returns the question in the form used in answer cache keys.
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import torch
+
+
+def image_key(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def normalize_question(question):
+    return " ".join(question.split()).casefold()
+
+
+def tensor_bytes(value):
+    return value.element_size() * value.nelement()
+
+
+class EncodingCache:
+    def __init__(self, max_bytes=512 * 1024 * 1024, disk_dir=None):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def disk_path(self, key):
+        return os.path.join(self.disk_dir, key[:2], f"{key}.pt")
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+
+        if self.disk_dir:
+            path = self.disk_path(key)
+            if os.path.exists(path):
+                value = torch.load(path, map_location="cpu")
+                with self.lock:
+                    self.disk_hits += 1
+                self.remember(key, value)
+                return value
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, value):
+        self.remember(key, value)
+
+        if self.disk_dir:
+            path = self.disk_path(key)
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # Write to a temporary file first so readers never see a partial tensor
+                tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                torch.save(value, tmp_path)
+                os.replace(tmp_path, path)
+
+    def remember(self, key, value):
+        size = tensor_bytes(value)
+        if size > self.max_bytes:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                self.size -= tensor_bytes(self.entries.pop(key))
+            self.entries[key] = value
+            self.size += size
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= tensor_bytes(evicted)
+
+    def get_or_encode(self, key, encode):
+        value = self.get(key)
+        if value is None:
+            value = encode()
+            self.put(key, value)
+        return value
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_ratio": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            }
+
+
+class AnswerCache:
+    def __init__(self, max_entries=10000, ttl=3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+
+    def get(self, key, question):
+        cache_key = (key, normalize_question(question))
+        with self.lock:
+            entry = self.entries.get(cache_key)
+            if entry is not None:
+                expires, answer = entry
+                if expires > time.monotonic():
+                    self.entries.move_to_end(cache_key)
+                    self.hits += 1
+                    return answer
+                del self.entries[cache_key]
+                self.expired += 1
+            self.misses += 1
+            return None
+
+    def put(self, key, question, answer):
+        if self.max_entries <= 0:
+            return
+
+        cache_key = (key, normalize_question(question))
+        with self.lock:
+            self.entries[cache_key] = (time.monotonic() + self.ttl, answer)
+            self.entries.move_to_end(cache_key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "expired": self.expired,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,204 @@
+"""
+Batched helpers around the moondream2 model.
+
+The model exposes single-image `encode_image` and `answer_question` calls. These helpers run
+several images or questions through the vision encoder and the text decoder as one batch, so
+concurrent requests share a forward pass instead of running at batch size 1.
+
+Functions:
+    encode_images(model, images): Encodes a list of PIL images, returns one encoding per image.
+    answer_questions(model, tokenizer, enc_images, questions, max_new_tokens, deadlines): Answers each
+        question about the matching encoded image with a single left-padded generate call.
+    stream_answer(model, tokenizer, enc_image, question, max_new_tokens, deadline): Yields the answer
+        text piece by piece while it is being decoded.
+    classify(model, tokenizer, enc_images, questions, label_sets): Scores a fixed set of labels for
+        each question with one forward pass instead of free-form generation. Every casing of a
+        label counts towards it.
+
+Deadlines are `time.monotonic()` values checked between decode steps. A sequence whose deadline
+passes before it produced EOS stops generating, its answer is None (answer_questions) or
+DeadlineExceeded is raised (stream_answer). Closing the stream_answer generator stops its generation the same way.
+"""
+import threading
+import time
+
+import torch
+from transformers import StoppingCriteria, StoppingCriteriaList, TextIteratorStreamer
+
+from admission import DeadlineExceeded
+
+
+def question_prompt(question):
+    return f"<image>\n\nQuestion: {question}\n\nAnswer:"
+
+
+def encode_images(model, images):
+    with torch.no_grad():
+        enc_images = model.encode_image(list(images))
+    # Keep the batch dimension so every item looks like the result of a single encode_image call.
+    # Clone, a view would keep the whole batch alive in the caches and torch.save would write all of it
+    return [enc_images[i:i + 1].clone() for i in range(enc_images.shape[0])]
+
+
+class DeadlineCriteria(StoppingCriteria):
+    def __init__(self, deadlines, eos_token_id=None):
+        self.deadlines = deadlines
+        self.eos_token_id = eos_token_id
+        self.expired = set()
+        self.finished = set()
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.cancelled:
+            return torch.ones(len(self.deadlines), dtype=torch.bool, device=input_ids.device)
+        # Rows that produced EOS keep being passed in while their neighbours decode, their answer is complete
+        if self.eos_token_id is not None and input_ids.shape[-1]:
+            self.finished.update((input_ids[:, -1] == self.eos_token_id).nonzero().flatten().tolist())
+        now = time.monotonic()
+        done = []
+        for row, deadline in enumerate(self.deadlines):
+            if row in self.finished:
+                done.append(True)
+            elif deadline is not None and deadline <= now:
+                self.expired.add(row)
+                done.append(True)
+            else:
+                done.append(False)
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+
+def generate_config(tokenizer, max_new_tokens):
+    return {
+        "eos_token_id": tokenizer.eos_token_id,
+        "bos_token_id": tokenizer.bos_token_id,
+        "pad_token_id": tokenizer.bos_token_id,
+        "max_new_tokens": max_new_tokens,
+    }
+
+
+def batch_inputs(model, tokenizer, enc_images, prompts):
+    with torch.no_grad():
+        prompt_embs = [
+            model.input_embeds(prompt, enc_image, tokenizer)[0]
+            for prompt, enc_image in zip(prompts, enc_images)
+        ]
+
+    # Left-pad with the BOS embedding so every sequence ends at the generation position
+    bos_emb = prompt_embs[0][0]
+    max_len = max(p.shape[0] for p in prompt_embs)
+    inputs_embeds = torch.stack([
+        torch.cat([bos_emb.repeat(max_len - p.shape[0], 1), p]) for p in prompt_embs
+    ])
+    attention_mask = torch.stack([
+        torch.cat([
+            torch.zeros(max_len - p.shape[0], dtype=torch.long, device=p.device),
+            torch.ones(p.shape[0], dtype=torch.long, device=p.device),
+        ])
+        for p in prompt_embs
+    ])
+    return inputs_embeds, attention_mask
+
+
+def answer_questions(model, tokenizer, enc_images, questions, max_new_tokens=256, deadlines=None):
+    prompts = [question_prompt(question) for question in questions]
+    inputs_embeds, attention_mask = batch_inputs(model, tokenizer, enc_images, prompts)
+    criteria = DeadlineCriteria(deadlines or [None] * len(prompts), tokenizer.eos_token_id)
+
+    with torch.no_grad():
+        output_ids = model.text_model.generate(
+            inputs_embeds=inputs_embeds,
+            attention_mask=attention_mask,
+            stopping_criteria=StoppingCriteriaList([criteria]),
+            **generate_config(tokenizer, max_new_tokens),
+        )
+    answers = tokenizer.batch_decode(output_ids, skip_special_tokens=True)
+    return [None if row in criteria.expired else answer.strip() for row, answer in enumerate(answers)]
+
+
+def stream_answer(model, tokenizer, enc_image, question, max_new_tokens=256, deadline=None):
+    inputs_embeds, attention_mask = batch_inputs(model, tokenizer, [enc_image], [question_prompt(question)])
+    streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True)
+    criteria = DeadlineCriteria([deadline], tokenizer.eos_token_id)
+    errors = []
+
+    def generate():
+        try:
+            with torch.no_grad():
+                model.text_model.generate(
+                    inputs_embeds=inputs_embeds,
+                    attention_mask=attention_mask,
+                    streamer=streamer,
+                    stopping_criteria=StoppingCriteriaList([criteria]),
+                    **generate_config(tokenizer, max_new_tokens),
+                )
+        except Exception as e:
+            errors.append(e)
+            # Unblock the consumer, it re-raises the error below
+            streamer.end()
+
+    thread = threading.Thread(target=generate, daemon=True)
+    thread.start()
+    try:
+        for text in streamer:
+            if text:
+                yield text
+    except GeneratorExit:
+        # The client went away: stop decoding at the next step and wait, so no model work
+        # outlives the request's admission slot and model handle
+        criteria.cancel()
+        thread.join()
+        raise
+    thread.join()
+    if errors:
+        raise errors[0]
+    if criteria.expired:
+        raise DeadlineExceeded()
+
+
+def label_token_ids(tokenizer, labels):
+    """Returns the first token ids of every casing of every label, raises ValueError if labels share one
+    or there are fewer than two."""
+    # With a single label the renormalised probability is always 1, whatever the model predicted
+    if len(labels) < 2:
+        raise ValueError("At least two labels are needed")
+    token_ids = []
+    for label in labels:
+        # The answer follows "Answer:", so the first answer token carries a leading space.
+        # The model usually answers "Yes" where the label says "yes", so every casing counts
+        variants = {label, label.lower(), label.capitalize(), label.upper()}
+        token_ids.append(sorted({tokenizer.encode(f" {variant}", add_special_tokens=False)[0] for variant in variants}))
+
+    seen = set()
+    for ids in token_ids:
+        if seen & set(ids):
+            raise ValueError(f"Labels {labels} do not start with distinct tokens")
+        seen.update(ids)
+    return token_ids
+
+
+def classify(model, tokenizer, enc_images, questions, label_sets):
+    prompts = [question_prompt(question) for question in questions]
+    inputs_embeds, attention_mask = batch_inputs(model, tokenizer, enc_images, prompts)
+
+    with torch.no_grad():
+        logits = model.text_model(inputs_embeds=inputs_embeds, attention_mask=attention_mask).logits[:, -1, :]
+
+    results = []
+    for row, labels in enumerate(label_sets):
+        # Labels are checked before they are batched, see label_token_ids
+        token_ids = label_token_ids(tokenizer, labels)
+        vocabulary = torch.softmax(logits[row].float(), dim=-1)
+        masses = [vocabulary[ids].sum().item() for ids in token_ids]
+        total = sum(masses)
+        scores = {label: mass / total if total else 0.0 for label, mass in zip(labels, masses)}
+        results.append({
+            "label": max(scores, key=scores.get),
+            "probabilities": scores,
+            # How much of the next-token distribution the labels cover, low means the model
+            # would rather answer with something else
+            "label_mass": total,
+        })
+    return results
@@ -0,0 +1,121 @@
+"""
+Loading of the moondream2 model and tokenizer.
+
+The model is loaded from a local snapshot directory with `local_files_only`, so starting a
+process does no hub lookups to resolve the revision. The snapshot is either given explicitly
+or resolved from the local Hugging Face cache, and only downloaded when it is not there yet.
+Running this file pre-resolves (downloads) the snapshot and prints its path, e.g. when
+building an image, so it can be passed as MOONDREAM_SNAPSHOT.
+
+    python loader.py [model_id] [revision]
+
+Classes:
+    ModelHandle: A loaded model and tokenizer with a count of the requests using them, so a
+        replaced model can be freed once its last request finishes.
+
+Functions:
+    resolve_snapshot(model_id, revision): Returns the local snapshot directory of the revision.
+    load_model(model_id, revision, quantize, snapshot): Loads the model and tokenizer, optionally quantized.
+    quantize_model(model, mode): Applies dynamic quantization to the linear layers of the model.
+
+Quantization:
+    "int8" replaces every torch.nn.Linear of the vision encoder and of the text decoder with a
+    dynamically quantized int8 version: weights are stored as int8 and activations are quantized
+    on the fly. It only applies to CPU inference.
+"""
+import ctypes
+import gc
+import sys
+import threading
+
+import torch
+from huggingface_hub import snapshot_download
+from transformers import AutoModelForCausalLM, AutoTokenizer
+
+QUANTIZE_MODES = {"int8": torch.qint8}
+
+
+def quantize_model(model, mode):
+    if mode not in QUANTIZE_MODES:
+        raise ValueError(f"Unknown quantization mode {mode!r}, expected one of {sorted(QUANTIZE_MODES)}")
+
+    return torch.ao.quantization.quantize_dynamic(
+        model, {torch.nn.Linear}, dtype=QUANTIZE_MODES[mode], inplace=True
+    )
+
+
+def resolve_snapshot(model_id, revision):
+    try:
+        return snapshot_download(model_id, revision=revision, local_files_only=True)
+    except Exception:
+        # Not in the local cache yet
+        return snapshot_download(model_id, revision=revision)
+
+
+def load_model(model_id, revision, quantize=None, snapshot=None):
+    path = snapshot or resolve_snapshot(model_id, revision)
+    model = AutoModelForCausalLM.from_pretrained(
+        path, trust_remote_code=True, local_files_only=True
+    )
+    tokenizer = AutoTokenizer.from_pretrained(path, local_files_only=True)
+    model.eval()
+
+    if quantize:
+        model = quantize_model(model, quantize)
+    return model, tokenizer
+
+
+
+def release_memory():
+    gc.collect()
+    # Return freed heap pages to the OS so RSS reflects the dropped weights (glibc only)
+    try:
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+class ModelHandle:
+    def __init__(self, model, tokenizer, revision):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.revision = revision
+        self.lock = threading.Lock()
+        self.refs = 0
+        self.retired = False
+        self.on_freed = None
+
+    def acquire(self):
+        with self.lock:
+            self.refs += 1
+        return self
+
+    def release(self):
+        with self.lock:
+            self.refs -= 1
+            free = self.retired and self.refs == 0
+        if free:
+            self.free()
+
+    def retire(self, on_freed=None):
+        """Marks the model as replaced, it is freed as soon as no request uses it."""
+        with self.lock:
+            self.retired = True
+            self.on_freed = on_freed
+            free = self.refs == 0
+        if free:
+            self.free()
+
+    def free(self):
+        self.model = None
+        self.tokenizer = None
+        release_memory()
+        if self.on_freed:
+            self.on_freed(self)
+
+
+if __name__ == "__main__":
+    print(resolve_snapshot(
+        sys.argv[1] if len(sys.argv) > 1 else "vikhyatk/moondream2",
+        sys.argv[2] if len(sys.argv) > 2 else "2024-08-26",
+    ))
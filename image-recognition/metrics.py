@@ -0,0 +1,121 @@
+"""
+Minimal Prometheus metrics for the image recognition API.
+
+Only what the API needs: histograms with one optional label, gauges that are set directly or
+read from a callback at scrape time, and rendering of the text exposition format.
+
+Every process keeps its own values, so with the pre-fork server (serve.py) every scrape shows
+the worker that accepted the connection.
+
+Classes:
+    Histogram: Cumulative bucket histogram, with a `time()` context manager.
+    Gauge: Value set by the caller, or computed by a callback when scraped.
+
+Functions:
+    render(): Returns all registered metrics in the Prometheus text format.
+    process_rss(): Returns the resident set size of this process in bytes.
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+registry = []
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels.items()) + "}"
+
+
+class Histogram:
+    def __init__(self, name, help, label=None, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.series = {}
+        registry.append(self)
+
+    def observe(self, value, label_value=None):
+        with self.lock:
+            series = self.series.setdefault(label_value, {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0})
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["buckets"][i] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    @contextmanager
+    def time(self, label_value=None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, label_value)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for label_value, series in self.series.items():
+                labels = {self.label: label_value} if self.label else {}
+                for bound, bucket in zip(self.buckets, series["buckets"]):
+                    lines.append(f"{self.name}_bucket{format_labels({**labels, 'le': bound})} {bucket}")
+                lines.append(f"{self.name}_bucket{format_labels({**labels, 'le': '+Inf'})} {series['count']}")
+                lines.append(f"{self.name}_sum{format_labels(labels)} {series['sum']}")
+                lines.append(f"{self.name}_count{format_labels(labels)} {series['count']}")
+        return lines
+
+
+class Gauge:
+    def __init__(self, name, help, fn=None, label=None, kind="gauge"):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.label = label
+        self.kind = kind
+        self.value = 0
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set(self, value):
+        self.value = value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        value = self.fn() if self.fn else self.value
+        if isinstance(value, dict):
+            for label_value, item in value.items():
+                lines.append(f"{self.name}{format_labels({self.label: label_value})} {item}")
+        else:
+            lines.append(f"{self.name} {value}")
+        return lines
+
+
+def render():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def process_rss():
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        import resource
+        # ru_maxrss is the peak in kilobytes, the closest portable substitute
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
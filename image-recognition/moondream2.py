@@ -2,7 +2,7 @@
 This script uses a pre-trained language model to describe the content of an image.
 
 Modules:
-    transformers: Provides the AutoModelForCausalLM and AutoTokenizer classes for loading the pre-trained model and tokenizer.
+    transformers: Provides the AutoModelForCausalLM and AutoTokenizer classes for loading the pre-trained model and tokenizer (see loader.py).
     PIL: Provides the Image class for opening and manipulating images.
 
 Constants:
@@ -13,26 +13,270 @@ Constants:
 Functions:
     encode_image(image): Encodes the image using the pre-trained model.
     answer_question(encoded_image, question, tokenizer): Uses the pre-trained model to answer a question about the encoded image.
+    caption_directory(model, tokenizer, directory, output, ...): Captions every image under a directory into a JSONL file.
+    caption_video(model, tokenizer, source, output, ...): Writes a timestamped caption track for a video or image sequence.
 
 Usage:
     The script loads a pre-trained model and tokenizer, opens an image, encodes the image, and then uses the model to answer a question about the image. The response is printed to the console.
+
+    python moondream2.py [image_path] [--question "Describe this image."] [--quantize int8]
+
+Batch mode:
+    Walks a directory, decodes images in a thread pool ahead of the model, encodes and answers them
+    in batches and appends one JSON line per image to the output file as soon as its batch is done.
+    Images already present in the output file are skipped, so an interrupted run resumes where it
+    stopped. Images per second are reported while running.
+
+    Images whose perceptual hash is within --max-distance bits of an image captioned before reuse
+    its answer instead of running the model, and are recorded with "duplicate_of".
+
+    python moondream2.py --dir ./photos --output captions.jsonl --batch-size 8 --decoders 4
+
+Video mode:
+    Samples --sample-fps frames per second from a video file (decoded by ffmpeg) or from a directory
+    of frames (--fps sets its frame rate), keeps only the frames where the scene changes (see
+    video.py) and captions those keyframes. Every caption lasts until the next keyframe. The track
+    is written as WebVTT, SRT or JSONL depending on the --output extension, and the speed is
+    reported as seconds of video processed per wall-clock second.
+
+    python moondream2.py --video ./clip.mp4 --output clip.vtt --sample-fps 2 --scene-threshold 0.3
 """
 
-from transformers import AutoModelForCausalLM, AutoTokenizer
+import argparse
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 from PIL import Image
 
+from loader import load_model
+from inference import encode_images, answer_questions
+from preprocess import load_image
+from phash import PerceptualIndex, dhash
+from video import keyframes, probe, sequence_frames, video_frames, write_track
+
 model_id = "vikhyatk/moondream2"
 revision = "2024-08-26"
 
-model = AutoModelForCausalLM.from_pretrained(
-    model_id, trust_remote_code=True, revision=revision
-)
-tokenizer = AutoTokenizer.from_pretrained(model_id, revision=revision)
-
 image_path = "./ba.png"
-image = Image.open(image_path)
+question = "Describe this image."
+#question = "Does this image contains sexual context?"
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".bmp", ".gif"}
+
+
+def find_images(directory):
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+                yield os.path.join(root, name)
+
+
+def read_done(output):
+    records = []
+    if os.path.exists(output):
+        with open(output) as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # A line cut short by an interrupted run
+                    continue
+                if "answer" in record:
+                    records.append(record)
+    return records
+
+
+def decode(path):
+    with open(path, "rb") as file:
+        return load_image(file.read())
+
+
+def prefetch(paths, decoders, ahead):
+    # Keep up to `ahead` images decoding in the pool while the model works on the current batch
+    with ThreadPoolExecutor(decoders) as pool:
+        pending = deque()
+        for path in paths:
+            pending.append((path, pool.submit(decode, path)))
+            if len(pending) >= ahead:
+                yield pending.popleft()
+        while pending:
+            yield pending.popleft()
+
+
+def batches(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def caption_directory(model, tokenizer, directory, output, question=question, batch_size=8, decoders=4, max_distance=4):
+    records = read_done(output)
+    done = {record["path"] for record in records}
+    paths = [path for path in find_images(directory) if os.path.relpath(path, directory) not in done]
+    print(f"{len(done)} images already captioned, {len(paths)} to go", file=sys.stderr)
+
+    # Index of captioned images, the payload is the position in `originals`
+    index = PerceptualIndex(max_distance, payload_size=8) if max_distance >= 0 else None
+    originals = []
+
+    def remember(name, image_hash, answer):
+        if index is not None and image_hash is not None:
+            index.add(int(image_hash, 16), len(originals).to_bytes(8, "little"))
+            originals.append((name, answer))
+
+    for record in records:
+        if "duplicate_of" not in record and record.get("question") == question:
+            remember(record["path"], record.get("dhash"), record["answer"])
+
+    started = time.perf_counter()
+    captioned = 0
+    with open(output, "a") as file:
+        # Finish a line cut short by an interrupted run, or the first new record would be glued onto it
+        if file.tell() > 0:
+            with open(output, "rb") as existing:
+                existing.seek(-1, os.SEEK_END)
+                if existing.read(1) != b"\n":
+                    file.write("\n")
+        for batch in batches(prefetch(paths, decoders, batch_size * 2), batch_size):
+            images = []
+            names = []
+            hashes = []
+            for path, future in batch:
+                name = os.path.relpath(path, directory)
+                try:
+                    image = future.result()
+                except Exception as e:
+                    file.write(json.dumps({"path": name, "error": str(e)}) + "\n")
+                    continue
+
+                image_hash = f"{dhash(image):016x}"
+                match = index.nearest(int(image_hash, 16)) if index is not None else None
+                if match is not None:
+                    original, answer = originals[int.from_bytes(match[0], "little")]
+                    file.write(json.dumps({
+                        "path": name, "question": question, "answer": answer,
+                        "dhash": image_hash, "duplicate_of": original,
+                    }) + "\n")
+                    captioned += 1
+                    continue
+
+                images.append(image)
+                names.append(name)
+                hashes.append(image_hash)
+
+            if images:
+                enc_images = encode_images(model, images)
+                answers = answer_questions(model, tokenizer, enc_images, [question] * len(enc_images))
+                for name, image_hash, answer in zip(names, hashes, answers):
+                    file.write(json.dumps({"path": name, "question": question, "answer": answer, "dhash": image_hash}) + "\n")
+                    remember(name, image_hash, answer)
+            file.flush()
+
+            captioned += len(images)
+            elapsed = time.perf_counter() - started
+            print(f"{captioned}/{len(paths)} images, {captioned / elapsed:.2f} images/s", file=sys.stderr)
+
+    elapsed = time.perf_counter() - started
+    if captioned:
+        print(f"Captioned {captioned} images in {elapsed:.1f}s, {captioned / elapsed:.2f} images/s", file=sys.stderr)
+
+
+def caption_video(model, tokenizer, source, output, question=question, sample_fps=2, fps=25,
+                  threshold=0.3, max_gap=30, batch_size=8):
+    if os.path.isdir(source):
+        frames = sequence_frames(source, fps=fps, sample_fps=sample_fps)
+        duration = 0
+    else:
+        frames = video_frames(source, sample_fps=sample_fps)
+        duration = probe(source)[2]
+
+    progress = {"sampled": 0, "timestamp": 0.0}
+
+    def counted(frames):
+        for timestamp, image in frames:
+            progress["sampled"] += 1
+            progress["timestamp"] = timestamp
+            yield timestamp, image
+
+    started = time.perf_counter()
+    segments = []
+    for batch in batches(keyframes(counted(frames), threshold, max_gap), batch_size):
+        timestamps, images = zip(*batch)
+        enc_images = encode_images(model, images)
+        answers = answer_questions(model, tokenizer, enc_images, [question] * len(enc_images))
+        segments.extend({"start": timestamp, "caption": answer} for timestamp, answer in zip(timestamps, answers))
+
+        elapsed = time.perf_counter() - started
+        print(
+            f"{progress['timestamp']:.1f}s of video, {len(segments)} keyframes of {progress['sampled']} sampled frames, "
+            f"{progress['timestamp'] / elapsed:.2f} video s/s",
+            file=sys.stderr,
+        )
+
+    end = max(duration, progress["timestamp"] + 1 / sample_fps)
+    for segment, following in zip(segments, segments[1:] + [{"start": end}]):
+        segment["end"] = following["start"]
+    write_track(segments, output)
+
+    elapsed = time.perf_counter() - started
+    print(
+        f"Captioned {end:.1f}s of video with {len(segments)} keyframes of {progress['sampled']} sampled frames "
+        f"in {elapsed:.1f}s, {end / elapsed:.2f} video seconds per second",
+        file=sys.stderr,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Describe images using moondream v2")
+    parser.add_argument("image_path", nargs="?", default=image_path)
+    parser.add_argument("--question", default=question)
+    parser.add_argument("--dir", help="Caption every image under this directory")
+    parser.add_argument("--video", help="Caption a video file or a directory of frames")
+    parser.add_argument("--output", default="captions.jsonl")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--decoders", type=int, default=4)
+    parser.add_argument("--sample-fps", type=float, default=2, help="Frames per second sampled from a video")
+    parser.add_argument("--fps", type=float, default=25, help="Frame rate of a directory of frames")
+    parser.add_argument("--scene-threshold", type=float, default=0.3, help="Difference from the last keyframe that starts a new scene")
+    parser.add_argument("--max-gap", type=float, default=30, help="Longest time in seconds between keyframes")
+    parser.add_argument("--quantize", choices=["int8"], help="Run the linear layers with dynamic quantization")
+    parser.add_argument("--max-distance", type=int, default=4, help="Near-duplicate Hamming distance, negative disables")
+    args = parser.parse_args()
+
+    model, tokenizer = load_model(model_id, revision, quantize=args.quantize)
+
+    if args.video:
+        caption_video(
+            model, tokenizer, args.video, args.output,
+            question=args.question, sample_fps=args.sample_fps, fps=args.fps,
+            threshold=args.scene_threshold, max_gap=args.max_gap, batch_size=args.batch_size,
+        )
+        return
+
+    if args.dir:
+        caption_directory(
+            model, tokenizer, args.dir, args.output,
+            question=args.question, batch_size=args.batch_size, decoders=args.decoders,
+            max_distance=args.max_distance,
+        )
+        return
+
+    image = Image.open(args.image_path)
+
+    enc_image = model.encode_image(image)
+    response = model.answer_question(enc_image, args.question, tokenizer)
+    print(response)
+
 
-enc_image = model.encode_image(image)
-response = model.answer_question(enc_image, "Describe this image.", tokenizer)
-#response = model.answer_question(enc_image, "Does this image contains sexual context?", tokenizer)
-print(response)
+if __name__ == "__main__":
+    main()
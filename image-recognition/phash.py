@@ -0,0 +1,126 @@
+"""
+Perceptual hashing and a near-duplicate index for images.
+
+Resized or re-encoded copies of a picture have different bytes, so a content hash misses them,
+but their difference hashes (dHash) differ in only a few bits. The index finds a stored hash
+within a Hamming distance of a query using multi-index hashing: the 64 bits are split into
+`max_distance + 1` chunks, and by the pigeonhole principle any hash within `max_distance` bits
+matches the query exactly in at least one chunk. Only the hashes sharing a chunk are compared.
+
+Storage is array backed to hold millions of entries: hashes in an array of unsigned 64-bit
+integers, payloads in one bytearray with a fixed width per entry, and per chunk tables mapping
+a chunk value to an array of 32-bit positions.
+
+Classes:
+    PerceptualIndex: Near-duplicate index with fixed size payloads, can be saved to and loaded from a file.
+
+Functions:
+    dhash(image, size): Returns the 64-bit difference hash of a PIL image.
+    vertical_dhash(image, size): Returns the 64-bit difference hash of vertically adjacent pixels,
+        a second hash to confirm a match of the first.
+"""
+import struct
+import threading
+from array import array
+
+from PIL import Image
+
+HEADER = struct.Struct("<4sIIQ")
+MAGIC = b"PHIX"
+
+
+def dhash(image, size=8):
+    small = image.convert("L").resize((size + 1, size), Image.BOX)
+    pixels = small.tobytes()
+    value = 0
+    for row in range(size):
+        offset = row * (size + 1)
+        for col in range(size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def vertical_dhash(image, size=8):
+    return dhash(image.transpose(Image.TRANSPOSE), size)
+
+
+class PerceptualIndex:
+    def __init__(self, max_distance=4, payload_size=32):
+        if not 0 <= max_distance < 32:
+            raise ValueError("max_distance must be between 0 and 31")
+
+        self.max_distance = max_distance
+        self.payload_size = payload_size
+        self.lock = threading.Lock()
+        self.hashes = array("Q")
+        self.payloads = bytearray()
+
+        # Split 64 bits into max_distance + 1 chunks of (nearly) equal width
+        chunks = max_distance + 1
+        self.chunks = []
+        shift = 0
+        for i in range(chunks):
+            width = 64 // chunks + (i < 64 % chunks)
+            self.chunks.append((shift, (1 << width) - 1))
+            shift += width
+        self.tables = [{} for _ in self.chunks]
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def add(self, value, payload):
+        with self.lock:
+            position = len(self.hashes)
+            self.hashes.append(value)
+            self.payloads += payload[:self.payload_size].ljust(self.payload_size, b"\0")
+            for table, (shift, mask) in zip(self.tables, self.chunks):
+                positions = table.get((value >> shift) & mask)
+                if positions is None:
+                    positions = table[(value >> shift) & mask] = array("I")
+                positions.append(position)
+            return position
+
+    def nearest(self, value, max_distance=None):
+        """Returns (payload, distance) of the closest stored hash, or None if none is close enough."""
+        if max_distance is None or max_distance > self.max_distance:
+            max_distance = self.max_distance
+
+        best = None
+        best_distance = max_distance + 1
+        seen = set()
+        with self.lock:
+            for table, (shift, mask) in zip(self.tables, self.chunks):
+                for position in table.get((value >> shift) & mask, ()):
+                    if position in seen:
+                        continue
+                    seen.add(position)
+                    distance = (self.hashes[position] ^ value).bit_count()
+                    if distance < best_distance:
+                        best, best_distance = position, distance
+                        if distance == 0:
+                            break
+            if best is None:
+                return None
+            start = best * self.payload_size
+            return bytes(self.payloads[start:start + self.payload_size]), best_distance
+
+    def save(self, path):
+        with self.lock, open(path, "wb") as file:
+            file.write(HEADER.pack(MAGIC, self.max_distance, self.payload_size, len(self.hashes)))
+            self.hashes.tofile(file)
+            file.write(self.payloads)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as file:
+            magic, max_distance, payload_size, count = HEADER.unpack(file.read(HEADER.size))
+            if magic != MAGIC:
+                raise ValueError(f"{path} is not a perceptual hash index")
+            hashes = array("Q")
+            hashes.fromfile(file, count)
+            payloads = file.read(count * payload_size)
+
+        index = cls(max_distance, payload_size)
+        for position, value in enumerate(hashes):
+            index.add(value, payloads[position * payload_size:(position + 1) * payload_size])
+        return index
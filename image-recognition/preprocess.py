@@ -0,0 +1,61 @@
+"""
+Fast image decoding and size limits applied before images reach the moondream2 encoder.
+
+The vision encoder works on 378x378 crops and resizes every input down anyway, so decoding
+large uploads at full resolution only costs time and memory. This stage:
+    - rejects uploads above a byte budget before decoding anything,
+    - reads the image header and rejects images above a pixel budget before decoding pixels,
+    - lets the JPEG decoder scale down by 1/2, 1/4 or 1/8 while decoding (draft mode),
+    - resizes to at most `max_side` pixels on the longest side and converts to RGB.
+
+The default `max_side` is twice the encoder input size, which keeps enough detail for the
+encoder's high resolution crops.
+
+Environment Variables:
+    IMAGE_MAX_BYTES: Maximum upload size in bytes (default 20 MB).
+    IMAGE_MAX_PIXELS: Maximum width * height of an upload (default 50 megapixels).
+    IMAGE_MAX_SIDE: Longest side after preprocessing (default 756).
+
+Classes:
+    ImageRejected: Raised when an upload breaks one of the limits.
+
+Functions:
+    load_image(data): Decodes the uploaded bytes into a reduced RGB image.
+"""
+import io
+import os
+
+from PIL import Image
+
+ENCODER_SIZE = 378
+
+MAX_BYTES = int(os.getenv("IMAGE_MAX_BYTES", str(20 * 1024 * 1024)))
+MAX_PIXELS = int(os.getenv("IMAGE_MAX_PIXELS", str(50_000_000)))
+MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", str(2 * ENCODER_SIZE)))
+
+
+class ImageRejected(ValueError):
+    pass
+
+
+def load_image(data, max_side=MAX_SIDE, max_bytes=MAX_BYTES, max_pixels=MAX_PIXELS):
+    if len(data) > max_bytes:
+        raise ImageRejected(f"Image is {len(data)} bytes, the limit is {max_bytes}")
+
+    # Opening only parses the header, pixels are decoded on load()
+    image = Image.open(io.BytesIO(data))
+    width, height = image.size
+    if width * height > max_pixels:
+        raise ImageRejected(f"Image is {width}x{height} pixels, the limit is {max_pixels} pixels")
+
+    # Let the JPEG decoder skip detail we are going to throw away
+    if image.format == "JPEG":
+        image.draft("RGB", (max_side, max_side))
+
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    if max(image.size) > max_side:
+        image.thumbnail((max_side, max_side), Image.BICUBIC)
+    else:
+        image.load()
+    return image
@@ -0,0 +1,390 @@
+"""
+Pre-fork production server for the image recognition API.
+
+The parent process imports api.py and loads the moondream2 weights once, then forks the
+workers. Workers share the weight pages copy-on-write, so adding a worker costs roughly its
+activations and interpreter state instead of another copy of the model.
+
+The parent never runs the model: the OpenMP thread pool used by torch is not safe to use in a
+child forked after the parent used it. Every worker runs its own warmup in the background and
+answers /ready once it is done.
+
+Every worker accepts connections on the same listening socket and gets its own torch thread
+count, optionally pinned to its own set of cores, so workers do not fight over the CPU.
+
+Revision swaps: POST /admin/revision on any worker only records the revision and signals the
+parent (SIGUSR1). The parent loads the new weights and replaces the workers one at a time: a new
+worker is forked and warmed up, then the old one stops accepting connections and exits once its
+connections are closed (SIGUSR2): busy ones get their response with Connection: close, idle
+keep-alive ones are closed so clients reconnect to another worker. Capacity never drops and every
+worker ends up on the new revision. GET /admin/revision on any worker reports the progress and the
+RSS and PSS of the parent and the workers before, at the peak of and after the swap.
+
+Usage:
+    python serve.py --workers 4 --threads 2 --port 5000
+
+Arguments:
+    --workers: Number of worker processes (default: WORKERS env or 1).
+    --threads: Torch threads per worker (default: cores divided by workers).
+    --pin: Pin every worker to its own range of cores.
+    --swap-timeout: Seconds a new worker may take to get ready during a swap (default 600).
+
+Classes:
+    Connections: Tracks the client connections of a worker and drains them.
+    RollingSwap: Hands swap requests from the workers to the parent and shares the swap status.
+
+Functions:
+    worker(sock, index, threads, pin, ready_fd): Runs one WSGI server on the shared socket.
+    memory(pids): RSS and PSS of the parent and the given workers.
+    roll(swap, workers, draining, sock, threads, args): Loads a new revision and replaces every worker.
+    main(): Parses arguments, forks and supervises the workers.
+"""
+import argparse
+import gc
+import json
+import os
+import select
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import torch
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+import api
+
+
+class Connections:
+    """Open client connections of a worker, so it can drain them before it exits."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.draining = False
+
+    def handler(self):
+        connections = self
+
+        class Handler(WSGIRequestHandler):
+            def setup(self):
+                super().setup()
+                connections.update(self, True)
+
+            def parse_request(self):
+                # The request line has been read, the connection is busy until the response is sent
+                connections.update(self, False)
+                return super().parse_request()
+
+            def handle_one_request(self):
+                try:
+                    super().handle_one_request()
+                finally:
+                    connections.update(self, True)
+
+            def end_headers(self):
+                # Keep-alive clients reconnect to another worker instead of reusing this connection
+                if connections.draining and not self.close_connection:
+                    self.send_header("Connection", "close")
+                super().end_headers()
+
+            def finish(self):
+                try:
+                    super().finish()
+                finally:
+                    connections.remove(self)
+
+        return Handler
+
+    def update(self, handler, idle):
+        with self.lock:
+            self.idle[handler] = idle
+
+    def remove(self, handler):
+        with self.lock:
+            self.idle.pop(handler, None)
+
+    def drain(self):
+        """Closes idle keep-alive connections and waits until the busy ones answered their request."""
+        self.draining = True
+        while True:
+            with self.lock:
+                if not self.idle:
+                    return
+                idle = [handler.connection for handler, is_idle in self.idle.items() if is_idle]
+            for connection in idle:
+                try:
+                    # A connection with pending bytes carries a request that is about to be read, it gets
+                    # answered with Connection: close instead
+                    readable, _, _ = select.select([connection], [], [], 0)
+                    if not readable:
+                        connection.shutdown(socket.SHUT_RDWR)
+                except (OSError, ValueError):
+                    pass
+            time.sleep(0.1)
+
+
+class RollingSwap:
+    def __init__(self, directory, parent):
+        self.request_path = os.path.join(directory, "request")
+        self.status_path = os.path.join(directory, "status.json")
+        self.parent = parent
+
+    def request(self, revision):
+        """Called on a worker. Returns False if a swap is already in progress."""
+        try:
+            fd = os.open(self.request_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w") as file:
+            file.write(revision)
+        os.kill(self.parent, signal.SIGUSR1)
+        return True
+
+    def requested(self):
+        try:
+            with open(self.request_path) as file:
+                return file.read().strip() or None
+        except OSError:
+            return None
+
+    def finish(self):
+        os.remove(self.request_path)
+
+    def status(self):
+        try:
+            with open(self.status_path) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {"state": "idle"}
+
+    def update(self, reset=False, **fields):
+        status = {} if reset else self.status()
+        status.update(fields)
+        temporary = f"{self.status_path}.tmp"
+        with open(temporary, "w") as file:
+            json.dump(status, file)
+        os.replace(temporary, self.status_path)
+
+
+def worker(sock, index, threads, pin, ready_fd=None):
+    if pin and hasattr(os, "sched_setaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+        first = (index * threads) % len(cores)
+        os.sched_setaffinity(0, cores[first:first + threads] or cores)
+    torch.set_num_threads(threads)
+
+    # A worker that cannot warm up exits, the parent starts a new one
+    api.start(load_weights=False, exit_on_failure=True)
+    connections = Connections()
+    server = make_server(
+        sock.getsockname()[0], sock.getsockname()[1], api.app, threaded=True, fd=sock.fileno(),
+        request_handler=connections.handler(),
+    )
+
+    if ready_fd is not None:
+        def report_ready():
+            api.ready.wait()
+            os.write(ready_fd, b"1")
+            os.close(ready_fd)
+
+        threading.Thread(target=report_ready, daemon=True).start()
+
+    # SIGUSR2: stop accepting, the other workers take the new connections
+    signal.signal(signal.SIGUSR2, lambda signum, frame: threading.Thread(target=server.shutdown, daemon=True).start())
+
+    print(f"Worker {index} (pid {os.getpid()}) serving with {threads} threads", flush=True)
+    server.serve_forever()
+
+    # Requests run in daemon threads on keep-alive connections, which outlive the shutdown above
+    connections.drain()
+    print(f"Worker {index} (pid {os.getpid()}) drained", flush=True)
+
+
+def spawn(sock, index, threads, pin, ready_fd=None):
+    pid = os.fork()
+    if pid == 0:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+        try:
+            worker(sock, index, threads, pin, ready_fd)
+        finally:
+            os._exit(0)
+    return pid
+
+
+def wait_ready(pid, ready_r, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        readable, _, _ = select.select([ready_r], [], [], 1)
+        if readable and os.read(ready_r, 1):
+            return True
+        if os.waitpid(pid, os.WNOHANG)[0] == pid:
+            return False
+    return False
+
+
+def memory_kb(pid, field):
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as file:
+            for line in file:
+                if line.startswith(f"{field}:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def memory(pids):
+    """RSS and PSS in bytes of the parent and the workers. RSS counts the shared weight pages in every
+    process, PSS splits them, so total_pss is the real footprint."""
+    parent = os.getpid()
+    usage = {
+        "parent_rss": memory_kb(parent, "Rss") * 1024,
+        "parent_pss": memory_kb(parent, "Pss") * 1024,
+        "workers_rss": sum(memory_kb(pid, "Rss") for pid in pids) * 1024,
+        "workers_pss": sum(memory_kb(pid, "Pss") for pid in pids) * 1024,
+    }
+    usage["total_pss"] = usage["parent_pss"] + usage["workers_pss"]
+    return usage
+
+
+def roll(swap, workers, draining, sock, threads, args):
+    new_revision = swap.requested()
+    if new_revision is None:
+        return
+
+    previous = api.revision
+    before = memory(list(workers) + list(draining))
+    swap.update(
+        reset=True, state="loading", revision=new_revision, previous_revision=previous, started=time.time(),
+        memory_before=before,
+    )
+    peak = before
+    try:
+        started = time.perf_counter()
+        # Let the collector reach the old model again, it is freed once the old workers are gone
+        gc.unfreeze()
+        try:
+            api.load(new_revision)
+            gc.collect()
+        finally:
+            # Workers forked later must not copy the pages of a collection, even after a failed load
+            gc.freeze()
+        swap.update(state="rolling", load_seconds=time.perf_counter() - started, workers=len(workers), replaced=0)
+
+        for replaced, (old_pid, index) in enumerate(list(workers.items()), 1):
+            ready_r, ready_w = os.pipe()
+            new_pid = spawn(sock, index, threads, args.pin, ready_w)
+            os.close(ready_w)
+            try:
+                ok = wait_ready(new_pid, ready_r, args.swap_timeout)
+            finally:
+                os.close(ready_r)
+            if not ok:
+                try:
+                    os.kill(new_pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                raise RuntimeError(f"Worker {index} did not get ready on revision {new_revision}")
+
+            del workers[old_pid]
+            workers[new_pid] = index
+            # Sampled while the old worker drains, both revisions are resident at this point
+            during = memory(list(workers) + list(draining) + [old_pid])
+            if during["total_pss"] > peak["total_pss"]:
+                peak = during
+            try:
+                os.kill(old_pid, signal.SIGUSR2)
+                draining.add(old_pid)
+            except ProcessLookupError:
+                pass
+            swap.update(replaced=replaced, memory_peak=peak, overhead_bytes=peak["total_pss"] - before["total_pss"])
+            print(f"Worker {index} moved to revision {new_revision} (pid {old_pid} -> {new_pid})", flush=True)
+
+        # Done once the old workers have exited, see main()
+        swap.update(state="draining", draining_workers=len(draining))
+    except Exception as e:
+        # Workers replaced so far stay on the new revision, workers that crash later restart on it too
+        swap.update(state="failed", error=str(e), finished=time.time())
+        print(f"Revision swap to {new_revision} failed: {e}", flush=True)
+    finally:
+        swap.finish()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pre-fork server for the image recognition API")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WORKERS", "1")))
+    parser.add_argument("--threads", type=int, default=0)
+    parser.add_argument("--pin", action="store_true")
+    parser.add_argument("--swap-timeout", type=float, default=600)
+    args = parser.parse_args()
+
+    threads = args.threads or max(1, (os.cpu_count() or 1) // args.workers)
+
+    api.load()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((args.host, args.port))
+    sock.listen(128)
+    sock.set_inheritable(True)
+
+    control = tempfile.mkdtemp(prefix="moondream-serve-")
+    swap = RollingSwap(control, os.getpid())
+    api.swap_hook = swap
+
+    # Move everything allocated so far out of the collector's reach, otherwise the first
+    # collection in every worker touches (and copies) the pages of all long-lived objects
+    gc.collect()
+    gc.freeze()
+
+    workers = {spawn(sock, index, threads, args.pin): index for index in range(args.workers)}
+    # Old workers of a revision swap that finish their requests before they exit
+    draining = set()
+    print(f"Serving on {args.host}:{args.port} with {args.workers} workers", flush=True)
+
+    swap_requested = threading.Event()
+
+    def stop(signum, frame):
+        for pid in [*workers, *draining]:
+            os.kill(pid, signal.SIGTERM)
+        shutil.rmtree(control, ignore_errors=True)
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGUSR1, lambda signum, frame: swap_requested.set())
+
+    # Replace workers that die so the server keeps its capacity
+    while True:
+        if swap_requested.is_set():
+            swap_requested.clear()
+            roll(swap, workers, draining, sock, threads, args)
+
+        pid, status = os.waitpid(-1, os.WNOHANG)
+        if pid == 0:
+            time.sleep(0.2)
+            continue
+        if pid in draining:
+            draining.discard(pid)
+            if not draining:
+                fields = {"state": "done", "finished": time.time()} if swap.status().get("state") == "draining" else {}
+                swap.update(memory_after=memory(workers), **fields)
+                print(f"Revision {api.revision} serving on every worker, old workers drained", flush=True)
+            continue
+
+        index = workers.pop(pid, None)
+        if index is not None:
+            print(f"Worker {index} (pid {pid}) exited with status {status}, restarting", flush=True)
+            workers[spawn(sock, index, threads, args.pin)] = index
+
+
+if __name__ == "__main__":
+    main()
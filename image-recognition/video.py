@@ -0,0 +1,139 @@
+"""
+Frame sampling and scene-change detection for captioning videos and image sequences.
+
+Frames are sampled at a fixed rate, so a video never has to be decoded frame by frame in
+Python: ffmpeg decodes, drops frames down to `sample_fps` and scales them before piping raw RGB
+frames. A directory of images is treated as a sequence with a fixed frame rate.
+
+A cheap detector compares every sampled frame with the last keyframe on a tiny grayscale
+thumbnail, using the mean pixel difference and the difference of the brightness histograms.
+Only frames that start a new scene (or follow the previous keyframe by more than `max_gap`
+seconds) are passed on to the model.
+
+Functions:
+    video_frames(path, sample_fps, max_side): Yields (timestamp, PIL image) sampled from a video file.
+    sequence_frames(directory, fps, sample_fps): Yields (timestamp, PIL image) from a directory of images.
+    keyframes(frames, threshold, max_gap): Yields the frames that start a new scene.
+    write_track(segments, output): Writes the caption track as WebVTT, SRT or JSONL by file extension.
+
+Classes:
+    SceneDetector: Decides if a frame differs enough from the last keyframe.
+"""
+import json
+import os
+import subprocess
+
+from PIL import Image, ImageChops, ImageStat
+
+from preprocess import MAX_SIDE
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".bmp"}
+
+
+def probe(path):
+    output = subprocess.check_output([
+        "ffprobe", "-v", "error", "-select_streams", "v:0",
+        "-show_entries", "stream=width,height:format=duration", "-of", "json", path,
+    ])
+    info = json.loads(output)
+    stream = info["streams"][0]
+    return stream["width"], stream["height"], float(info["format"].get("duration", 0))
+
+
+def video_frames(path, sample_fps=2, max_side=MAX_SIDE):
+    width, height, _ = probe(path)
+    scale = min(1.0, max_side / max(width, height))
+    # Even sizes keep every pixel format happy
+    width, height = max(2, int(width * scale) // 2 * 2), max(2, int(height * scale) // 2 * 2)
+    frame_size = width * height * 3
+
+    process = subprocess.Popen(
+        [
+            "ffmpeg", "-v", "error", "-i", path,
+            "-vf", f"fps={sample_fps},scale={width}:{height}",
+            "-f", "rawvideo", "-pix_fmt", "rgb24", "-",
+        ],
+        stdout=subprocess.PIPE,
+    )
+    try:
+        index = 0
+        while True:
+            data = process.stdout.read(frame_size)
+            if len(data) < frame_size:
+                break
+            yield index / sample_fps, Image.frombytes("RGB", (width, height), data)
+            index += 1
+    finally:
+        process.stdout.close()
+        process.kill()
+        process.wait()
+
+
+def sequence_frames(directory, fps=25, sample_fps=2, max_side=MAX_SIDE):
+    names = sorted(name for name in os.listdir(directory) if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS)
+    step = max(1, round(fps / sample_fps))
+    for index in range(0, len(names), step):
+        image = Image.open(os.path.join(directory, names[index]))
+        image.draft("RGB", (max_side, max_side))
+        image = image.convert("RGB")
+        image.thumbnail((max_side, max_side))
+        yield index / fps, image
+
+
+class SceneDetector:
+    def __init__(self, threshold=0.3, size=(64, 36)):
+        self.threshold = threshold
+        self.size = size
+        self.last = None
+        self.last_histogram = None
+
+    def thumbnail(self, image):
+        return image.convert("L").resize(self.size, Image.BILINEAR)
+
+    def is_new_scene(self, image, force=False):
+        thumbnail = self.thumbnail(image)
+        histogram = thumbnail.histogram()
+        if self.last is None or force:
+            changed = True
+        else:
+            pixels = self.size[0] * self.size[1]
+            pixel_difference = ImageStat.Stat(ImageChops.difference(thumbnail, self.last)).mean[0] / 255
+            histogram_difference = sum(abs(a - b) for a, b in zip(histogram, self.last_histogram)) / (2 * pixels)
+            changed = max(pixel_difference, histogram_difference) > self.threshold
+
+        if changed:
+            self.last = thumbnail
+            self.last_histogram = histogram
+        return changed
+
+
+def keyframes(frames, threshold=0.3, max_gap=30):
+    detector = SceneDetector(threshold)
+    last_keyframe = None
+    for timestamp, image in frames:
+        force = last_keyframe is not None and timestamp - last_keyframe >= max_gap
+        if detector.is_new_scene(image, force):
+            last_keyframe = timestamp
+            yield timestamp, image
+
+
+def format_timestamp(seconds, separator):
+    milliseconds = round(seconds * 1000)
+    hours, milliseconds = divmod(milliseconds, 3600000)
+    minutes, milliseconds = divmod(milliseconds, 60000)
+    seconds, milliseconds = divmod(milliseconds, 1000)
+    return f"{hours:02}:{minutes:02}:{seconds:02}{separator}{milliseconds:03}"
+
+
+def write_track(segments, output):
+    extension = os.path.splitext(output)[1].lower()
+    with open(output, "w") as file:
+        if extension == ".vtt":
+            file.write("WEBVTT\n\n")
+        for number, segment in enumerate(segments, 1):
+            if extension == ".vtt":
+                file.write(f"{format_timestamp(segment['start'], '.')} --> {format_timestamp(segment['end'], '.')}\n{segment['caption']}\n\n")
+            elif extension == ".srt":
+                file.write(f"{number}\n{format_timestamp(segment['start'], ',')} --> {format_timestamp(segment['end'], ',')}\n{segment['caption']}\n\n")
+            else:
+                file.write(json.dumps(segment) + "\n")
@@ -0,0 +1,74 @@
+"""
+Benchmark of the encoding stage: WAV file plus ffmpeg process against in-memory encoding.
+
+A synthetic buffer of the length of a MusicGen sample is encoded the old way (scipy WAV file,
+`ffmpeg -i` process, WAV removed) and with encoder.encode for every supported format. The report
+shows the median latency and the bytes written to disk per sample.
+
+Usage:
+    python bench_encode.py --seconds 30 --repeat 5
+
+Output:
+    A table with method, median milliseconds and kilobytes written.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+import scipy
+
+import encoder
+
+SAMPLING_RATE = 32000
+
+
+def wav_and_ffmpeg(audio, directory):
+    filenameWav = os.path.join(directory, "sample.wav")
+    filename = os.path.join(directory, "sample.mp3")
+    scipy.io.wavfile.write(filenameWav, rate=SAMPLING_RATE, data=audio)
+    written = os.path.getsize(filenameWav)
+    subprocess.call(["ffmpeg", "-v", "error", "-y", "-i", filenameWav, filename])
+    os.remove(filenameWav)
+    return written + os.path.getsize(filename)
+
+
+def in_memory(extension, method):
+    def run(audio, directory):
+        filename = os.path.join(directory, f"sample{extension}")
+        method(audio, SAMPLING_RATE, filename)
+        return os.path.getsize(filename)
+    return run
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the encoding of generated samples")
+    parser.add_argument("--seconds", type=float, default=30)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    time_axis = np.arange(int(args.seconds * SAMPLING_RATE)) / SAMPLING_RATE
+    audio = (0.3 * np.sin(2 * np.pi * 440 * time_axis) + 0.05 * rng.standard_normal(time_axis.size)).astype(np.float32)
+
+    methods = {"wav + ffmpeg -i": wav_and_ffmpeg, "ffmpeg pipe mp3": in_memory(".mp3", encoder.encode_ffmpeg)}
+    if encoder.lameenc is not None:
+        methods["lameenc mp3"] = in_memory(".mp3", encoder.encode_lame)
+    methods["ffmpeg pipe opus"] = in_memory(".ogg", encoder.encode_ffmpeg)
+
+    print(f"{'method':<18} {'ms':>8} {'KB written':>11}")
+    with tempfile.TemporaryDirectory() as directory:
+        for name, method in methods.items():
+            timings = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                written = method(audio, directory)
+                timings.append(time.perf_counter() - start)
+            print(f"{name:<18} {statistics.median(timings) * 1000:>8.1f} {written / 1024:>11.0f}", flush=True)
+
+
+if __name__ == "__main__":
+    main()
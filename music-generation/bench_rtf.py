@@ -0,0 +1,173 @@
+"""
+Real-time-factor benchmark of MusicGen on CPU.
+
+For every combination of thread count, dtype, sample length and batch size the script times
+`model.generate` (median of the repeats after one warmup run) and reports:
+    tokens/s: audio tokens generated per second, every row of the batch counted,
+    RTF: seconds of audio produced per second of compute, above 1 is faster than real time.
+
+It runs fully offline. `--model` loads facebook/musicgen-small (or any MusicGen checkpoint) from
+the local Hugging Face cache or a directory only. `--tiny` builds a small randomly initialized
+model from MusicgenConfig with the codebooks and frame rate of musicgen-small, which exercises the
+same code path without any download and is meant for comparing machines and library versions,
+not for listening.
+
+Results are written as JSON together with the machine, torch and transformers versions, so runs
+can be compared. `--baseline` prints the speedup over a previous results file for matching rows.
+
+Usage:
+    python bench_rtf.py --threads 1,4,8 --dtypes float32,bfloat16 --tokens 128,256 --batch-sizes 1,4 --output rtf.json
+    python bench_rtf.py --tiny --output rtf-tiny.json --baseline rtf-tiny-old.json
+
+Output:
+    A table with threads, dtype, tokens, batch size, seconds, tokens/s and RTF, and the JSON file.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import time
+
+os.environ.setdefault("HF_HUB_OFFLINE", "1")
+
+import torch
+import transformers
+from transformers import (
+    AutoTokenizer,
+    EncodecConfig,
+    MusicgenConfig,
+    MusicgenDecoderConfig,
+    MusicgenForConditionalGeneration,
+    T5Config,
+)
+
+PROMPT = "upbeat soft rock with bright guitar riffs, 140 BPM"
+
+
+def tiny_model():
+    torch.manual_seed(0)
+    text_encoder = T5Config(vocab_size=1000, d_model=64, d_kv=16, d_ff=128, num_layers=2, num_heads=4)
+    # musicgen-small's audio side: 32 kHz, 50 frames per second, 4 codebooks of 2048 entries
+    audio_encoder = EncodecConfig(
+        sampling_rate=32000, upsampling_ratios=[8, 5, 4, 4], target_bandwidths=[2.2],
+        codebook_size=2048, hidden_size=32, num_filters=8, num_lstm_layers=1,
+    )
+    decoder = MusicgenDecoderConfig(
+        vocab_size=2048, hidden_size=64, ffn_dim=128, num_hidden_layers=2, num_attention_heads=4, num_codebooks=4,
+    )
+    model = MusicgenForConditionalGeneration(MusicgenConfig.from_sub_models_config(text_encoder, audio_encoder, decoder))
+    model.generation_config.decoder_start_token_id = 2048
+    model.generation_config.pad_token_id = 2048
+    model.generation_config.bos_token_id = 2048
+    return model, None
+
+
+def cached_model(name):
+    model = MusicgenForConditionalGeneration.from_pretrained(name, local_files_only=True)
+    return model, AutoTokenizer.from_pretrained(name, local_files_only=True)
+
+
+def inputs(model, tokenizer, batch_size):
+    if tokenizer is not None:
+        return tokenizer([PROMPT] * batch_size, padding=True, return_tensors="pt")
+    input_ids = torch.randint(0, model.config.text_encoder.vocab_size, (batch_size, 12))
+    return {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)}
+
+
+def run(model, model_inputs, tokens):
+    start = time.perf_counter()
+    with torch.inference_mode():
+        audio_values = model.generate(**model_inputs, do_sample=True, max_new_tokens=tokens)
+    return time.perf_counter() - start, audio_values.shape[-1] / model.config.audio_encoder.sampling_rate
+
+
+def machine():
+    cpu = platform.processor()
+    try:
+        with open("/proc/cpuinfo") as file:
+            cpu = next(line.split(":", 1)[1].strip() for line in file if line.startswith("model name"))
+    except (OSError, StopIteration):
+        pass
+    return {
+        "cpu": cpu,
+        "cores": os.cpu_count(),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "transformers": transformers.__version__,
+    }
+
+
+def row_key(row):
+    return row["threads"], row["dtype"], row["tokens"], row["batch_size"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark MusicGen tokens per second and real-time factor on CPU")
+    parser.add_argument("--model", default="facebook/musicgen-small", help="cached model id or local directory")
+    parser.add_argument("--tiny", action="store_true", help="use a small randomly initialized model")
+    parser.add_argument("--threads", default=str(torch.get_num_threads()))
+    parser.add_argument("--dtypes", default="float32,bfloat16")
+    parser.add_argument("--tokens", default="128,256", help="new audio tokens per sample, 50 per second of audio")
+    parser.add_argument("--batch-sizes", default="1,4")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", default="rtf.json")
+    parser.add_argument("--baseline", help="previous results file to compare with")
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = {row_key(row): row for row in json.load(file)["results"]}
+
+    results = []
+    print(f"{'threads':>7} {'dtype':>9} {'tokens':>6} {'batch':>5} {'s':>8} {'tokens/s':>9} {'RTF':>6} {'vs base':>8}")
+    for dtype in args.dtypes.split(","):
+        # A fresh copy per dtype, casting back and forth would lose precision
+        model, tokenizer = tiny_model() if args.tiny else cached_model(args.model)
+        model = model.to(getattr(torch, dtype)).eval()
+        for threads in [int(value) for value in args.threads.split(",")]:
+            torch.set_num_threads(threads)
+            for tokens in [int(value) for value in args.tokens.split(",")]:
+                for batch_size in [int(value) for value in args.batch_sizes.split(",")]:
+                    model_inputs = inputs(model, tokenizer, batch_size)
+                    run(model, model_inputs, min(tokens, 16))
+                    timings = []
+                    for _ in range(args.repeat):
+                        elapsed, audio_seconds = run(model, model_inputs, tokens)
+                        timings.append(elapsed)
+                    elapsed = statistics.median(timings)
+
+                    row = {
+                        "threads": threads,
+                        "dtype": dtype,
+                        "tokens": tokens,
+                        "batch_size": batch_size,
+                        "seconds": elapsed,
+                        "tokens_per_second": tokens * batch_size / elapsed,
+                        "audio_seconds": audio_seconds * batch_size,
+                        "rtf": audio_seconds * batch_size / elapsed,
+                        "timings": timings,
+                    }
+                    results.append(row)
+
+                    base = baseline.get(row_key(row))
+                    speedup = f"{base['seconds'] / elapsed:>7.2f}x" if base else f"{'-':>8}"
+                    print(
+                        f"{threads:>7} {dtype:>9} {tokens:>6} {batch_size:>5} {elapsed:>8.2f} "
+                        f"{row['tokens_per_second']:>9.1f} {row['rtf']:>6.2f} {speedup}",
+                        flush=True,
+                    )
+
+    with open(args.output, "w") as file:
+        json.dump({
+            "model": "tiny" if args.tiny else args.model,
+            "machine": machine(),
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "repeat": args.repeat,
+            "results": results,
+        }, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""
+Content-addressed cache of generated music files.
+
+A result is stored under a hash of the normalized prompt, the model id and the generation
+parameters, so a repeated prompt is answered with the stored file instead of a new MusicGen run,
+and changing the model or the parameters never returns a stale result.
+
+The files live in one directory, named by their key. A SQLite index keeps their sizes and the
+time of the last use; once the files exceed the disk budget the least recently used ones are
+removed.
+
+Classes:
+    ResultCache: The cache with its index, eviction and hit/miss counters.
+
+Functions:
+    normalize_prompt(prompt): Returns the prompt in the form used in cache keys.
+    result_key(prompt, model_id, params): Returns the content hash used as the cache key.
+"""
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import unicodedata
+
+
+def normalize_prompt(prompt):
+    return " ".join(unicodedata.normalize("NFC", prompt).split()).casefold()
+
+
+def result_key(prompt, model_id, params):
+    payload = json.dumps(
+        {"prompt": normalize_prompt(prompt), "model": model_id, "params": params},
+        sort_keys=True, ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    def __init__(self, directory, max_bytes=1024 * 1024 * 1024, extension=".mp3"):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.extension = extension
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(self.directory, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(directory, "index.db"), check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS results (
+                key TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL,
+                last_used REAL NOT NULL,
+                hits INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        self.db.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)")
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}{self.extension}")
+
+    def get(self, key, record=True):
+        """Returns the path of the stored file, or None. `record=False` leaves the hit/miss counters alone."""
+        with self.lock:
+            path = self.path(key)
+            found = self.db.execute("SELECT 1 FROM results WHERE key = ?", (key,)).fetchone()
+            if found and os.path.exists(path):
+                self.db.execute(
+                    "UPDATE results SET last_used = ?, hits = hits + 1 WHERE key = ?", (time.time(), key)
+                )
+                self.hits += record
+                return path
+
+            if found:
+                # The file was removed behind the index's back
+                self.db.execute("DELETE FROM results WHERE key = ?", (key,))
+            self.misses += record
+            return None
+
+    def put(self, key, source):
+        """Moves `source` into the cache and returns its new path."""
+        path = self.path(key)
+        temporary = f"{path}.{threading.get_ident()}.tmp"
+        shutil.move(source, temporary)
+        os.replace(temporary, path)
+
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO results (key, size, created, last_used) VALUES (?, ?, ?, ?)",
+                (key, os.path.getsize(path), now, now),
+            )
+            self.evict(keep=key)
+        return path
+
+    def evict(self, keep=None):
+        total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        rows = self.db.execute("SELECT key, size FROM results ORDER BY last_used").fetchall()
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            # Open file handles keep working after the unlink, so a file being sent is safe
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+            self.db.execute("DELETE FROM results WHERE key = ?", (key,))
+            total -= size
+
+    def stats(self):
+        with self.lock:
+            entries, size = self.db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results").fetchone()
+            lookups = self.hits + self.misses
+            return {
+                "entries": entries,
+                "bytes": size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
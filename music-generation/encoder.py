@@ -0,0 +1,70 @@
+"""
+Encoding of generated audio from the numpy buffer straight to MP3 or OGG/Opus.
+
+Writing a WAV file and converting it with an ffmpeg process costs a process spawn and two full
+disk round trips per sample. Here the buffer is encoded in memory and only the final file is
+written:
+    mp3: lameenc in the same process, when it is installed.
+    mp3 without lameenc, ogg, opus: ffmpeg reading raw float samples from a pipe, no WAV file.
+
+Functions:
+    encode(audio, sampling_rate, path): Writes the audio to `path` in the format of its extension.
+    encode_lame(audio, sampling_rate, path): Writes an MP3 with lameenc.
+    encode_ffmpeg(audio, sampling_rate, path): Writes any supported format with ffmpeg fed through stdin.
+"""
+import os
+import subprocess
+
+import numpy as np
+
+try:
+    import lameenc
+except ImportError:
+    lameenc = None
+
+MP3_BITRATE = 192
+FFMPEG_CODECS = {
+    ".mp3": ["-c:a", "libmp3lame", "-b:a", f"{MP3_BITRATE}k"],
+    ".ogg": ["-c:a", "libopus", "-b:a", "96k"],
+    ".opus": ["-c:a", "libopus", "-b:a", "96k"],
+}
+
+
+def channels(audio):
+    # Buffers are (samples,) or (samples, channels), as written by scipy.io.wavfile
+    return 1 if audio.ndim == 1 else audio.shape[1]
+
+
+def encode_lame(audio, sampling_rate, path):
+    encoder = lameenc.Encoder()
+    encoder.set_bit_rate(MP3_BITRATE)
+    encoder.set_in_sample_rate(sampling_rate)
+    encoder.set_channels(channels(audio))
+    encoder.set_quality(2)
+
+    pcm = (np.clip(audio, -1.0, 1.0) * 32767).astype("<i2")
+    data = encoder.encode(pcm.tobytes()) + encoder.flush()
+    with open(path, "wb") as file:
+        file.write(data)
+
+
+def encode_ffmpeg(audio, sampling_rate, path):
+    subprocess.run(
+        [
+            "ffmpeg", "-v", "error", "-y",
+            "-f", "f32le", "-ar", str(sampling_rate), "-ac", str(channels(audio)), "-i", "-",
+            *FFMPEG_CODECS[os.path.splitext(path)[1].lower()], path,
+        ],
+        input=np.ascontiguousarray(audio, dtype="<f4").tobytes(),
+        check=True,
+    )
+
+
+def encode(audio, sampling_rate, path):
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in FFMPEG_CODECS:
+        raise ValueError(f"Unsupported audio format: {extension}")
+    if extension == ".mp3" and lameenc is not None:
+        encode_lame(audio, sampling_rate, path)
+    else:
+        encode_ffmpeg(audio, sampling_rate, path)
@@ -0,0 +1,168 @@
+"""
+Local stand-in for the Telegram Bot API, to load test the bot offline.
+
+The server answers the Bot API methods the bot uses under /bot<token>/<method>, counts the calls
+and the uploaded bytes, and reports them at /stats. Point the bot at it with TELEGRAM_API_URL in
+telegram-bot.py, which sets `telebot.apihelper.API_URL = "http://127.0.0.1:8081/bot{0}/{1}"`.
+
+With --load the script also plays Telegram's side of the webhook: it posts synthetic message
+updates to the bot's webhook from many concurrent clients, reports updates per second and the
+webhook latency, then waits for the replies and files the bot sends back.
+
+Usage:
+    python fake_telegram.py --port 8081
+    python fake_telegram.py --port 8081 --load http://127.0.0.1:8443/webhook --updates 10000 --concurrency 100
+
+Output:
+    Updates per second, p50/p99 webhook latency, errors, and the API calls the bot made.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import time
+from collections import Counter
+
+import aiohttp
+from aiohttp import web
+
+
+class FakeTelegram:
+    def __init__(self):
+        self.calls = Counter()
+        self.uploaded = 0
+        self.message_ids = itertools.count(1)
+
+    def message(self, params, **fields):
+        chat_id = int(params.get("chat_id", 0))
+        return {
+            "message_id": next(self.message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            **fields,
+        }
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        self.calls[method] += 1
+
+        # telebot sends the parameters in the query string and the files as multipart
+        params = dict(request.query)
+        if request.content_type == "multipart/form-data":
+            async for part in await request.multipart():
+                if part.filename:
+                    self.uploaded += len(await part.read())
+                else:
+                    params[part.name] = await part.text()
+        elif request.can_read_body:
+            params.update(await request.post())
+
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Stand-in", "username": "stand_in_bot"}
+        elif method == "getUpdates":
+            # Long polling gets nothing, updates only arrive through the webhook
+            await asyncio.sleep(min(float(params.get("timeout", 1)), 1))
+            result = []
+        elif method == "sendMessage":
+            result = self.message(params, text=params.get("text", ""))
+        elif method in ("sendDocument", "sendAudio"):
+            number = next(self.message_ids)
+            result = self.message(params, document={"file_id": f"file{number}", "file_unique_id": f"unique{number}"})
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def stats(self, request):
+        return web.json_response({"calls": dict(self.calls), "uploaded_bytes": self.uploaded})
+
+    def app(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_route("*", "/bot{token}/{method}", self.handle)
+        app.router.add_get("/stats", self.stats)
+        return app
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def update(number, chats, prompts):
+    chat_id = 1000 + number % chats
+    return {
+        "update_id": number,
+        "message": {
+            "message_id": number,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "Load"},
+            "text": f"load test prompt {number % prompts}",
+        },
+    }
+
+
+async def load(args):
+    headers = {"X-Telegram-Bot-Api-Secret-Token": args.secret} if args.secret else {}
+    numbers = iter(range(args.updates))
+    latencies = []
+    errors = 0
+
+    async def client(session):
+        nonlocal errors
+        for number in numbers:
+            start = time.perf_counter()
+            try:
+                async with session.post(args.load, data=json.dumps(update(number, args.chats, args.prompts)), headers=headers) as response:
+                    ok = response.status == 200
+            except aiohttp.ClientError:
+                ok = False
+            if ok:
+                latencies.append(time.perf_counter() - start)
+            else:
+                errors += 1
+
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        start = time.perf_counter()
+        await asyncio.gather(*(client(session) for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - start
+
+    print(
+        f"{len(latencies)} updates in {elapsed:.2f} s: {len(latencies) / elapsed:.0f} updates/s, "
+        f"p50 {percentile(latencies, 0.5) * 1000:.1f} ms, p99 {percentile(latencies, 0.99) * 1000:.1f} ms, "
+        f"{errors} errors",
+        flush=True,
+    )
+
+
+async def main(args):
+    telegram = FakeTelegram()
+    runner = web.AppRunner(telegram.app())
+    await runner.setup()
+    await web.TCPSite(runner, args.host, args.port).start()
+    print(f"Bot API stand-in at http://{args.host}:{args.port}/bot{{0}}/{{1}}", flush=True)
+
+    if not args.load:
+        await asyncio.Event().wait()
+
+    await load(args)
+    # Replies are sent from the bot's handler threads after the webhook has answered
+    await asyncio.sleep(args.settle)
+    print(f"API calls: {dict(telegram.calls)}, uploaded {telegram.uploaded / 1024 / 1024:.1f} MB")
+    await runner.cleanup()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Telegram Bot API stand-in and webhook load generator")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--load", help="webhook URL to post synthetic updates to")
+    parser.add_argument("--secret", help="secret token the webhook expects")
+    parser.add_argument("--updates", type=int, default=10000)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--chats", type=int, default=1000)
+    parser.add_argument("--prompts", type=int, default=50)
+    parser.add_argument("--settle", type=float, default=10)
+    asyncio.run(main(parser.parse_args()))
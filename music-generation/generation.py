@@ -0,0 +1,91 @@
+"""
+Batched MusicGen generation through the model and tokenizer of a text-to-audio pipeline.
+
+On CPU a batch of several prompts costs much less than the same prompts one by one: the decoder
+runs one step for the whole batch and the matrix multiplications use the cores better. The
+prompts are padded to the longest one, the attention mask keeps the padding out of the text
+encoder, and MusicGen generates the same number of audio tokens for every row, so the results are
+split back out without trimming.
+
+Previews: generate passes every step of audio tokens to a streamer. PreviewStreamer collects
+them, and once the first `preview_seconds` are complete it undoes the codebook delay pattern and
+decodes just those frames with the audio encoder, so the beginning of every track can be sent
+long before generation ends. The streamer only reads the tokens, the final output is unchanged.
+
+Functions:
+    generate_batch(synthesiser, prompts, params, streamer): Returns one {"audio", "sampling_rate"} result per prompt.
+
+Classes:
+    PreviewStreamer: Decodes the first seconds of every row of a batch while it is generated.
+"""
+import logging
+import math
+
+import torch
+from transformers.generation.streamers import BaseStreamer
+
+
+def to_buffer(audio):
+    # (channels, samples) to what scipy.io.wavfile expects: (samples,) or (samples, channels)
+    return audio[0] if audio.shape[0] == 1 else audio.T
+
+
+def generate_batch(synthesiser, prompts, params, streamer=None):
+    inputs = synthesiser.tokenizer(prompts, padding=True, return_tensors="pt").to(synthesiser.device)
+    with torch.inference_mode():
+        audio_values = synthesiser.model.generate(**inputs, **params, streamer=streamer)
+    sampling_rate = synthesiser.model.config.audio_encoder.sampling_rate
+
+    return [
+        {"audio": to_buffer(audio), "sampling_rate": sampling_rate}
+        for audio in audio_values.float().cpu().numpy()
+    ]
+
+
+class PreviewStreamer(BaseStreamer):
+    def __init__(self, model, preview_seconds, on_preview):
+        self.decoder = model.decoder
+        self.audio_encoder = model.audio_encoder
+        self.generation_config = model.generation_config
+        self.sampling_rate = model.config.audio_encoder.sampling_rate
+        self.num_codebooks = self.decoder.num_codebooks
+        self.on_preview = on_preview
+        # Codebook k lags k steps behind the first one, a frame is complete once the last one has it
+        self.preview_steps = math.ceil(preview_seconds * model.config.audio_encoder.frame_rate) + self.num_codebooks
+        self.tokens = None
+        self.done = False
+
+    def put(self, value):
+        if self.done:
+            return
+        # The first call gets the decoder start tokens (batch * codebooks, 1), then one token per row and step
+        value = value if value.dim() == 2 else value[:, None]
+        self.tokens = value if self.tokens is None else torch.cat([self.tokens, value], dim=-1)
+        if self.tokens.shape[-1] < self.preview_steps:
+            return
+
+        self.done = True
+        try:
+            self.on_preview(self.decode(self.tokens))
+        except Exception:
+            logging.exception("could not decode the preview")
+
+    def decode(self, tokens):
+        _, delay_pattern_mask = self.decoder.build_delay_pattern_mask(
+            tokens[:, :1],
+            pad_token_id=self.generation_config.decoder_start_token_id,
+            max_length=tokens.shape[-1],
+        )
+        tokens = self.decoder.apply_delay_pattern_mask(tokens, delay_pattern_mask)
+        # Every codebook row keeps the same number of frames once the delay padding is dropped
+        batch_size = tokens.shape[0] // self.num_codebooks
+        audio_codes = tokens[tokens != self.generation_config.pad_token_id].reshape(batch_size, self.num_codebooks, -1)
+        audio_values = self.audio_encoder.decode(audio_codes[None].to(self.audio_encoder.device), [None]).audio_values
+
+        return [
+            {"audio": to_buffer(audio), "sampling_rate": self.sampling_rate}
+            for audio in audio_values.float().cpu().numpy()
+        ]
+
+    def end(self):
+        pass
@@ -0,0 +1,256 @@
+"""
+Persistent store of music generation jobs shared by the Telegram receiver and the generation workers.
+
+Every prompt is a row in a SQLite table that goes through the states
+    queued -> running -> done | failed
+with the times it was created, started and finished, the output path or the error. Jobs that
+were queued or running when the bot stopped are queued again on startup and picked up by the
+workers.
+
+Identical prompts are coalesced: a job put with the cache key of a job that is queued or running
+is stored as
+    attached -> done | failed
+with the id of that job as its leader, and ends with the leader's result instead of being
+generated again. Attached jobs count
+towards the chat limits and survive a restart; attached jobs whose leader ended are queued. Finished jobs are kept for `retention` seconds and give the queue depth and latency
+statistics used to tune the number of workers and the batch size.
+
+Limits per chat:
+    max_per_chat: Jobs a chat may have queued or running at once, further prompts are refused.
+    max_running_per_chat: Jobs of one chat generated at the same time, so one busy chat cannot
+        occupy every worker while other chats wait.
+
+Classes:
+    Job: A queued prompt and the message it answers.
+    ChatLimitReached: Raised by JobQueue.put when the chat already has too many jobs, attached ones included.
+    JobQueue: The job store and queue, jobs can be taken one at a time or in batches.
+"""
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+Job = namedtuple("Job", "id chat_id message_id prompt")
+
+COLUMNS = {
+    "started": "REAL",
+    "finished": "REAL",
+    "output_path": "TEXT",
+    "error": "TEXT",
+    "key": "TEXT",
+    "leader": "INTEGER",
+}
+
+
+class ChatLimitReached(Exception):
+    def __init__(self, active):
+        super().__init__(f"Chat already has {active} jobs")
+        self.active = active
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class JobQueue:
+    def __init__(self, path, max_per_chat=3, max_running_per_chat=1, retention=7 * 24 * 3600):
+        self.max_per_chat = max_per_chat
+        self.max_running_per_chat = max_running_per_chat
+        self.retention = retention
+        self.condition = threading.Condition()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id INTEGER NOT NULL,
+                message_id INTEGER,
+                prompt TEXT NOT NULL,
+                state TEXT NOT NULL DEFAULT 'queued',
+                created REAL NOT NULL
+            )
+        """)
+        # Tables created before the job history was kept lack the newer columns
+        existing = {row[1] for row in self.db.execute("PRAGMA table_info(jobs)")}
+        for name, kind in COLUMNS.items():
+            if name not in existing:
+                self.db.execute(f"ALTER TABLE jobs ADD COLUMN {name} {kind}")
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_key ON jobs (key, state)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS jobs_leader ON jobs (leader, state)")
+
+        # Jobs that were running when the process stopped go back to the queue
+        self.resumed = self.db.execute(
+            "UPDATE jobs SET state = 'queued', started = NULL WHERE state = 'running'"
+        ).rowcount
+        # Attached jobs whose leader ended before they did are generated themselves, or hit the cache
+        self.resumed += self.db.execute("""
+            UPDATE jobs SET state = 'queued', leader = NULL WHERE state = 'attached' AND NOT EXISTS (
+                SELECT 1 FROM jobs AS leader WHERE leader.id = jobs.leader AND leader.state IN ('queued', 'running')
+            )
+        """).rowcount
+        self.prune()
+
+    def put(self, chat_id, message_id, prompt, key=None):
+        """Queues a prompt and returns the job id, its position in the queue and whether it attached to
+        a queued or running job with the same key, in which case the position is that job's."""
+        with self.condition:
+            active = self.db.execute(
+                "SELECT COUNT(*) FROM jobs WHERE chat_id = ? AND state IN ('queued', 'running', 'attached')", (chat_id,)
+            ).fetchone()[0]
+            if active >= self.max_per_chat:
+                raise ChatLimitReached(active)
+
+            leader = None
+            if key is not None:
+                leader = self.db.execute(
+                    "SELECT id, state FROM jobs WHERE key = ? AND state IN ('queued', 'running') ORDER BY id LIMIT 1",
+                    (key,),
+                ).fetchone()
+
+            leader_id, leader_state = leader or (None, None)
+            job_id = self.db.execute(
+                "INSERT INTO jobs (chat_id, message_id, prompt, key, leader, state, created) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (chat_id, message_id, prompt, key, leader_id, "attached" if leader else "queued", time.time()),
+            ).lastrowid
+            if leader is None:
+                self.condition.notify()
+                return job_id, self.position(job_id), False
+            return job_id, self.position(leader_id) if leader_state == "queued" else 0, True
+
+    def position(self, job_id):
+        return self.db.execute(
+            "SELECT COUNT(*) FROM jobs WHERE state = 'queued' AND id <= ?", (job_id,)
+        ).fetchone()[0]
+
+    def take(self):
+        """Blocks until a job is available and marks it as running."""
+        return self.take_batch(1)[0]
+
+    def take_batch(self, max_size, max_wait=0):
+        """Blocks until a job is available, then waits up to `max_wait` seconds for up to `max_size` jobs."""
+        with self.condition:
+            jobs = self.claim(max_size)
+            while not jobs:
+                self.condition.wait()
+                jobs = self.claim(max_size)
+
+            deadline = time.monotonic() + max_wait
+            while len(jobs) < max_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+                jobs += self.claim(max_size - len(jobs))
+            return jobs
+
+    def claim(self, limit):
+        # Oldest queued jobs first, skipping chats at their running limit
+        running = dict(self.db.execute(
+            "SELECT chat_id, COUNT(*) FROM jobs WHERE state = 'running' GROUP BY chat_id"
+        ).fetchall())
+        rows = self.db.execute(
+            "SELECT id, chat_id, message_id, prompt FROM jobs WHERE state = 'queued' ORDER BY id"
+        ).fetchall()
+
+        jobs = []
+        now = time.time()
+        for row in rows:
+            if len(jobs) >= limit:
+                break
+            job = Job(*row)
+            if running.get(job.chat_id, 0) >= self.max_running_per_chat:
+                continue
+            running[job.chat_id] = running.get(job.chat_id, 0) + 1
+            self.db.execute("UPDATE jobs SET state = 'running', started = ? WHERE id = ?", (now, job.id))
+            jobs.append(job)
+        return jobs
+
+    def end(self, job_id, state, output_path=None, error=None):
+        with self.condition:
+            # Only a running job can end, so a second call for the same job changes nothing
+            self.db.execute(
+                "UPDATE jobs SET state = ?, finished = ?, output_path = ?, error = ? WHERE id = ? AND state = 'running'",
+                (state, time.time(), output_path, error, job_id),
+            )
+            # A finished job can unblock queued jobs of the same chat
+            self.condition.notify_all()
+
+    def finish(self, job_id, output_path=None):
+        self.end(job_id, "done", output_path=output_path)
+
+    def fail(self, job_id, error):
+        self.end(job_id, "failed", error=str(error))
+
+    def end_attached(self, job_ids, state, output_path=None, error=None):
+        """Ends the jobs attached to the given jobs and returns them. Call it once the given jobs ended,
+        a prompt arriving after that is queued on its own instead of attaching to them."""
+        job_ids = list(job_ids)
+        with self.condition:
+            rows = self.db.execute(
+                f"SELECT id, chat_id, message_id, prompt FROM jobs WHERE state = 'attached' "
+                f"AND leader IN ({', '.join('?' * len(job_ids))}) ORDER BY id",
+                job_ids,
+            ).fetchall()
+            self.db.executemany(
+                "UPDATE jobs SET state = ?, finished = ?, output_path = ?, error = ? WHERE id = ?",
+                [(state, time.time(), output_path, error, row[0]) for row in rows],
+            )
+            return [Job(*row) for row in rows]
+
+    def finish_attached(self, job_ids, output_path):
+        return self.end_attached(job_ids, "done", output_path=output_path)
+
+    def fail_attached(self, job_ids, error):
+        return self.end_attached(job_ids, "failed", error=str(error))
+
+    def prune(self):
+        with self.condition:
+            self.db.execute(
+                "DELETE FROM jobs WHERE state IN ('done', 'failed') AND finished < ?", (time.time() - self.retention,)
+            )
+
+    def chat_jobs(self, chat_id):
+        """Returns (prompt, state, position) of the chat's unfinished jobs, attached ones included."""
+        with self.condition:
+            rows = self.db.execute(
+                "SELECT id, prompt, state FROM jobs WHERE chat_id = ? AND state IN ('queued', 'running', 'attached') ORDER BY id",
+                (chat_id,),
+            ).fetchall()
+            return [(prompt, state, self.position(job_id) if state == "queued" else 0) for job_id, prompt, state in rows]
+
+    def depth(self):
+        with self.condition:
+            return self.db.execute("SELECT COUNT(*) FROM jobs WHERE state = 'queued'").fetchone()[0]
+
+    def stats(self, window=3600):
+        """Counts by state, and wait and run times in seconds of the jobs finished in the last `window` seconds."""
+        with self.condition:
+            counts = dict(self.db.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+            # Attached jobs were never generated, they would skew the wait and run times
+            rows = self.db.execute(
+                "SELECT started - created, finished - started FROM jobs "
+                "WHERE state = 'done' AND leader IS NULL AND finished >= ?",
+                (time.time() - window,),
+            ).fetchall()
+            oldest = self.db.execute("SELECT MIN(created) FROM jobs WHERE state = 'queued'").fetchone()[0]
+
+        waits = [wait for wait, _ in rows]
+        runs = [run for _, run in rows]
+        return {
+            "queued": counts.get("queued", 0),
+            "running": counts.get("running", 0),
+            "attached": counts.get("attached", 0),
+            "done": counts.get("done", 0),
+            "failed": counts.get("failed", 0),
+            "resumed": self.resumed,
+            "oldest_queued_age": time.time() - oldest if oldest else 0.0,
+            "finished_per_hour": len(rows) * 3600 / window,
+            "wait_p50": percentile(waits, 0.5),
+            "wait_p95": percentile(waits, 0.95),
+            "run_p50": percentile(runs, 0.5),
+            "run_p95": percentile(runs, 0.95),
+        }
@@ -1,28 +1,43 @@
 """
-This script uses the Hugging Face Transformers library to generate a music track based on a text prompt.
+This script uses the Hugging Face Transformers library to generate music tracks based on text prompts.
 
 Imports:
+    import sys: Reads the prompts from the command line.
     from transformers import pipeline: Imports the pipeline function from the transformers library.
     import scipy: Imports the scipy library for handling audio file operations.
+    from generation import generate_batch: Generates several prompts as one padded batch.
 
 Variables:
     synthesiser: Initializes a text-to-audio pipeline using the "facebook/musicgen-small" model.
-    music: Generates a music track based on the provided text prompt with specific parameters.
+    prompts: The prompts given on the command line, or the default prompt.
+    BATCH_SIZE: The most prompts generated in one batch.
+    music: A generated music track.
 
 Functionality:
     - The script initializes a text-to-audio pipeline using the "facebook/musicgen-small" model.
-    - It generates a music track based on a detailed text prompt describing the desired characteristics of the track.
-    - The generated music is saved as a WAV file using the scipy library.
+    - It generates music tracks based on detailed text prompts describing the desired characteristics of the tracks,
+      up to BATCH_SIZE prompts at once, which on CPU is much faster than one prompt after another.
+    - The generated music is saved as WAV files using the scipy library.
+
+Usage:
+    python musicgen-small.py ["prompt" ...]
 
 Output:
-    The generated music is saved as "musicgen_out10.wav" with the specified sampling rate and audio data.
+    A single prompt is saved as "musicgen_out10.wav", several prompts as "musicgen_out10_1.wav", "musicgen_out10_2.wav", ...
 """
 
+import sys
 from transformers import pipeline
 import scipy
+from generation import generate_batch
+
+BATCH_SIZE = 4
 
 synthesiser = pipeline("text-to-audio", "facebook/musicgen-small")
 
-music = synthesiser("Create a track in the soft rock genre, fast-paced and dynamic, suitable for racing, but with elements that appeal to children. Use bright guitar riffs, an upbeat tempo around 140 BPM, cheerful keyboard melodies, and add fun sound effects, such as car honks or engine noises. The music should be energetic but not aggressive, maintaining a light and playful vibe for a kids' audience", forward_params={"do_sample": True})
+prompts = sys.argv[1:] or ["Create a track in the soft rock genre, fast-paced and dynamic, suitable for racing, but with elements that appeal to children. Use bright guitar riffs, an upbeat tempo around 140 BPM, cheerful keyboard melodies, and add fun sound effects, such as car honks or engine noises. The music should be energetic but not aggressive, maintaining a light and playful vibe for a kids' audience"]
 
-scipy.io.wavfile.write("musicgen_out10.wav", rate=music["sampling_rate"], data=music["audio"])
+for offset in range(0, len(prompts), BATCH_SIZE):
+    for number, music in enumerate(generate_batch(synthesiser, prompts[offset:offset + BATCH_SIZE], {"do_sample": True}), offset + 1):
+        filename = "musicgen_out10.wav" if len(prompts) == 1 else f"musicgen_out10_{number}.wav"
+        scipy.io.wavfile.write(filename, rate=music["sampling_rate"], data=music["audio"])
@@ -2,40 +2,117 @@
 """
 This script implements a Telegram bot that generates music samples based on text prompts using the Facebook MusicGen model.
 
+The message handlers only receive prompts: they put them into a persistent job store (see jobs.py)
+and reply with the position in the queue, so polling never waits for a generation. Every job is
+kept with its state, timestamps and output path, and jobs left unfinished by a restart are
+generated when the bot starts again. A pool of
+worker threads takes jobs from the queue, generates the samples and sends them back. A worker
+takes up to BATCH_SIZE pending jobs at once and generates their prompts as one padded batch
+(see generation.py), which on CPU costs much less than the same prompts one by one.
+
+Updates arrive by long polling, or in webhook mode (WEBHOOK_URL set) on an asyncio HTTP server that
+hands them to the handler threads (see webhook.py). For offline load tests TELEGRAM_API_URL can
+point the bot at the local Bot API stand-in in fake_telegram.py.
+
+Progressive delivery: as soon as the first PREVIEW_SECONDS of a batch are generated they are
+decoded and sent as a preview, while generation of the full tracks goes on.
+
+Generated files are kept in a content-addressed cache (see cache.py) keyed by the normalized
+prompt, the model id and the generation parameters, so a repeated prompt is answered at once.
+Identical prompts that arrive while the first one is still queued or generating are coalesced:
+they are stored as jobs attached to the first one (see jobs.py), so they count towards the chat
+limits, survive a restart, and get the same file.
+
 Modules:
     os: Provides a way of using operating system dependent functionality.
     telebot: A Python library for the Telegram Bot API.
-    scipy: A Python library used for scientific and technical computing.
-    subprocess: Allows you to spawn new processes, connect to their input/output/error pipes, and obtain their return codes.
     logging: Provides a way to configure logging for the script.
     datetime: Supplies classes for manipulating dates and times.
+    threading: Runs the generation workers.
     transformers: A library for state-of-the-art Natural Language Processing for Pytorch and TensorFlow 2.0.
+    jobs: The persistent job store and queue.
+    cache: The cache of generated files.
+    generation: Batched generation.
+    encoder: Encoding of the generated audio buffers, without WAV files.
+    webhook: The webhook front end.
 
 Functions:
     send_welcome(message): Sends a welcome message when the /start command is received.
-    send_file(message): Generates a music sample based on the received text prompt and sends the generated file back to the user.
+    send_queue(message): Lists the chat's prompts and their positions when the /queue command is received.
+    send_stats(message): Replies with the cache hits and misses, the queue depth and the job latencies when the /stats command is received.
+    send_file(message): Sends the cached file for the received text prompt, attaches to an identical generation in flight, or queues the prompt and replies with its position in the queue.
+    deliver(jobs, filename): Sends the generated file, or the failure without one, to jobs that attached to an identical prompt.
+    send_result(job, filename): Marks a job as done and sends the generated file back to its user.
+    complete(jobs, filename): Sends the generated file to jobs of one key and the jobs attached to them.
+    fail(jobs, error): Marks jobs of one key and the jobs attached to them as failed and reports the failure to them.
+    send_previews(keys, pending, previews): Encodes the previews of a batch and sends them to the users.
+    save(key, music, name): Encodes a generated sample to AUDIO_FORMAT in memory and stores it in the cache.
+    generate(jobs): Generates music samples for a batch of queued prompts and sends the generated files back to the users.
+    worker(): Takes batches of jobs from the queue and generates them, forever.
 
 Variables:
     synthesiser: A pipeline object for text-to-audio generation using the Facebook MusicGen model.
+    MODEL_ID: The model used by the synthesiser, part of the cache key.
+    GENERATION_PARAMS: The generation parameters, part of the cache key.
     BOT_TOKEN: The token for accessing the Telegram Bot API.
     FILES_DIRECTORY: The directory where generated files are stored.
+    CACHE_DIRECTORY: The directory of the result cache.
+    CACHE_MAX_MB: The disk budget of the result cache in megabytes.
+    AUDIO_FORMAT: The format of the sent files, mp3, ogg or opus.
+    QUEUE_DATABASE: The SQLite file of the job store.
+    WORKERS: The number of generation workers.
+    BATCH_SIZE: The most prompts a worker generates in one batch.
+    BATCH_WAIT: Seconds a worker waits for more prompts to fill a batch.
+    PREVIEW_SECONDS: The length of the preview sent before the full track, 0 turns previews off.
+    MAX_JOBS_PER_CHAT: The number of prompts a chat may have queued or generating at once.
+    MAX_RUNNING_PER_CHAT: The number of prompts of one chat generated at the same time.
+    HANDLER_THREADS: The number of threads running the message handlers.
+    WEBHOOK_URL: The public HTTPS URL of this server, webhook mode when set, long polling otherwise.
+    WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH: Where the webhook server listens.
+    WEBHOOK_SECRET: The secret token Telegram sends with every update.
+    TELEGRAM_API_URL: The Bot API URL template, empty for the real Telegram servers.
     log_filename: The name of the log file.
     bot: The TeleBot object for interacting with the Telegram Bot API.
 """
 
 import os
 import telebot
-import scipy
-import subprocess
 import os
 import logging
+import threading
 from datetime import datetime
 from transformers import pipeline
+from jobs import JobQueue, ChatLimitReached
+from cache import ResultCache, result_key
+from generation import generate_batch, PreviewStreamer
+from encoder import encode
+
+MODEL_ID = "facebook/musicgen-small"
+GENERATION_PARAMS = {"do_sample": True}
 
-synthesiser = pipeline("text-to-audio", "facebook/musicgen-small")
+synthesiser = pipeline("text-to-audio", MODEL_ID)
 
 BOT_TOKEN = '7.....2:A...........A'
 FILES_DIRECTORY = './files'
+CACHE_DIRECTORY = './files/cache'
+CACHE_MAX_MB = 1024
+AUDIO_FORMAT = 'mp3'
+QUEUE_DATABASE = './queue.db'
+
+WORKERS = 1
+BATCH_SIZE = 4
+BATCH_WAIT = 0.5
+PREVIEW_SECONDS = 5
+
+HANDLER_THREADS = 8
+WEBHOOK_URL = ''
+WEBHOOK_HOST = '0.0.0.0'
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = '/webhook'
+WEBHOOK_SECRET = ''
+TELEGRAM_API_URL = ''
+MAX_JOBS_PER_CHAT = 3
+MAX_RUNNING_PER_CHAT = 1
 
 log_filename = "server.log"
 
@@ -46,37 +123,214 @@ logging.basicConfig(
     datefmt='%Y-%m-%d %H:%M:%S'
 )
 
-bot = telebot.TeleBot(BOT_TOKEN)
+if TELEGRAM_API_URL:
+    telebot.apihelper.API_URL = TELEGRAM_API_URL
+
+bot = telebot.TeleBot(BOT_TOKEN, num_threads=HANDLER_THREADS)
+queue = JobQueue(QUEUE_DATABASE, max_per_chat=MAX_JOBS_PER_CHAT, max_running_per_chat=MAX_RUNNING_PER_CHAT)
+cache = ResultCache(CACHE_DIRECTORY, max_bytes=CACHE_MAX_MB * 1024 * 1024, extension=f".{AUDIO_FORMAT}")
+
+if queue.resumed or queue.depth():
+    logging.info(f"resuming {queue.depth()} unfinished jobs, {queue.resumed} of them were running")
 
 @bot.message_handler(commands=['start'])
 def send_welcome(message):
     bot.reply_to(message, "Hi! Send me music prompt and I'll generate the sample")
 
+@bot.message_handler(commands=['queue'])
+def send_queue(message):
+    jobs = queue.chat_jobs(message.chat.id)
+    if not jobs:
+        bot.reply_to(message, "You have no prompts in the queue")
+        return
+
+    lines = []
+    for prompt, state, position in jobs:
+        if state == "running":
+            status = "generating"
+        elif state == "attached":
+            status = "waiting for the same prompt sent earlier"
+        else:
+            status = f"number {position} in the queue"
+        lines.append(f"{prompt[:50]}: {status}")
+    bot.reply_to(message, "\n".join(lines))
+
+@bot.message_handler(commands=['stats'])
+def send_stats(message):
+    stats = cache.stats()
+    jobs = queue.stats()
+    bot.reply_to(
+        message,
+        f"Cache: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.0%}), "
+        f"{stats['entries']} files, {stats['bytes'] / 1024 / 1024:.1f} of {CACHE_MAX_MB} MB\n"
+        f"Queue: {jobs['queued']} waiting, {jobs['running']} generating, "
+        f"{jobs['attached']} waiting for an identical prompt\n"
+        f"Jobs: {jobs['done']} done, {jobs['failed']} failed, {jobs['finished_per_hour']:.0f} in the last hour, "
+        f"wait p50 {jobs['wait_p50']:.0f} s / p95 {jobs['wait_p95']:.0f} s, "
+        f"generation p50 {jobs['run_p50']:.0f} s / p95 {jobs['run_p95']:.0f} s"
+    )
+
 @bot.message_handler(func=lambda message: True)
 def send_file(message):
-    timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-    filenameWav = os.path.join(FILES_DIRECTORY, f"{timestamp}.wav")
-    filename = os.path.join(FILES_DIRECTORY, f"{timestamp}.mp3")
-
     prompt = message.text.strip()
 
-    filenamePrompt = os.path.join(FILES_DIRECTORY, os.path.normpath(prompt))
-    if os.path.exists(filenamePrompt):
-        with open(filenamePrompt, 'rb') as file:
-            bot.send_document(message.chat.id, file)
-    else:
-        bot.reply_to(message, "Got it, starting to generate...")
-        logging.info(f"{filename}: {prompt}")
+    key = result_key(prompt, MODEL_ID, GENERATION_PARAMS)
+    cached = cache.get(key)
+    if cached:
+        logging.info(f"cache hit: {prompt}")
+        with open(cached, 'rb') as file:
+            bot.send_document(message.chat.id, file, reply_to_message_id=message.message_id)
+        return
 
-        music = synthesiser(prompt, forward_params={"do_sample": True})
-        scipy.io.wavfile.write(filenameWav, rate=music["sampling_rate"], data=music["audio"])
-        subprocess.call(['ffmpeg', '-i', filenameWav, filename])
-        os.remove(filenameWav)
+    try:
+        job_id, position, attached = queue.put(message.chat.id, message.message_id, prompt, key)
+    except ChatLimitReached as e:
+        bot.reply_to(message, f"You already have {e.active} prompts in progress, please wait until they are done")
+        return
 
-        if os.path.exists(filename):
+    if attached:
+        logging.info(f"job {job_id} coalesced: {prompt}")
+        bot.reply_to(message, "Got it, the same prompt is already being generated, you will get the same file")
+        return
+
+    logging.info(f"job {job_id}: {prompt}")
+    if position <= 1:
+        bot.reply_to(message, "Got it, starting to generate...")
+    else:
+        bot.reply_to(message, f"Got it, you are number {position} in the queue")
+
+def deliver(jobs, filename=None):
+    for job in jobs:
+        try:
+            if filename is None:
+                bot.send_message(job.chat_id, "Sorry, the generation failed", reply_to_message_id=job.message_id)
+                continue
             with open(filename, 'rb') as file:
-                bot.send_document(message.chat.id, file)
+                bot.send_document(job.chat_id, file, reply_to_message_id=job.message_id)
+        except Exception:
+            logging.exception(f"job {job.id}: could not deliver the result of an identical prompt")
+
+def send_result(job, filename):
+    queue.finish(job.id, filename)
+    try:
+        with open(filename, 'rb') as file:
+            bot.send_document(job.chat_id, file, reply_to_message_id=job.message_id)
+    except Exception:
+        logging.exception(f"job {job.id}: could not send {filename}")
+
+def complete(jobs, filename):
+    for job in jobs:
+        send_result(job, filename)
+    # Attached jobs end after their leaders, a prompt arriving in between is queued on its own and hits
+    # the cache. Their uploads run on the handler threads, not on the generation worker.
+    attached = queue.finish_attached([job.id for job in jobs], filename)
+    if attached:
+        bot.worker_pool.put(deliver, attached, filename)
+
+def fail(jobs, error):
+    for job in jobs:
+        queue.fail(job.id, error)
+        try:
+            bot.send_message(job.chat_id, "Sorry, the generation failed", reply_to_message_id=job.message_id)
+        except Exception:
+            logging.exception(f"job {job.id}: could not report the failure")
+    attached = queue.fail_attached([job.id for job in jobs], error)
+    if attached:
+        bot.worker_pool.put(deliver, attached)
+
+def send_previews(keys, pending, previews):
+    for key, preview in zip(keys, previews):
+        filename = os.path.join(FILES_DIRECTORY, f"preview_{key}.{AUDIO_FORMAT}")
+        try:
+            encode(preview["audio"], preview["sampling_rate"], filename)
+            for job in pending[key]:
+                with open(filename, 'rb') as file:
+                    bot.send_document(
+                        job.chat_id, file, reply_to_message_id=job.message_id,
+                        caption=f"Preview of the first {PREVIEW_SECONDS} seconds, the full track is on its way"
+                    )
+        except Exception:
+            logging.exception(f"could not send the preview of {key}")
+        finally:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+def save(key, music, name):
+    timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+    filename = os.path.join(FILES_DIRECTORY, f"{timestamp}_{name}.{AUDIO_FORMAT}")
+
+    encode(music["audio"], music["sampling_rate"], filename)
+    return cache.put(key, filename)
+
+def generate(jobs):
+    # Jobs with the same key share one row of the batch
+    pending = {}
+    for job in jobs:
+        key = result_key(job.prompt, MODEL_ID, GENERATION_PARAMS)
+        # Jobs queued before a restart may be duplicates of one that is already done
+        cached = cache.get(key, record=False)
+        if cached:
+            complete([job], cached)
         else:
-            bot.reply_to(message, f"File {filename} not found")
+            pending.setdefault(key, []).append(job)
+    if not pending:
+        return
+
+    keys = list(pending)
+    prompts = [pending[key][0].prompt for key in keys]
+    logging.info(f"generating a batch of {len(prompts)}: {prompts}")
+    streamer = None
+    if PREVIEW_SECONDS:
+        # Sending runs beside the generation, so the preview does not hold up the full tracks
+        streamer = PreviewStreamer(synthesiser.model, PREVIEW_SECONDS, lambda previews: threading.Thread(
+            target=send_previews, args=(keys, pending, previews), daemon=True
+        ).start())
+    try:
+        musics = generate_batch(synthesiser, prompts, GENERATION_PARAMS, streamer=streamer)
+    except Exception as e:
+        logging.exception(f"batch failed: {e}")
+        for key in keys:
+            fail(pending[key], e)
+        return
+
+    for key, music in zip(keys, musics):
+        try:
+            filename = save(key, music, pending[key][0].id)
+        except Exception as e:
+            logging.exception(f"could not save {key}: {e}")
+            fail(pending[key], e)
+            continue
+        complete(pending[key], filename)
+
+def worker():
+    while True:
+        jobs = queue.take_batch(BATCH_SIZE, BATCH_WAIT)
+        try:
+            generate(jobs)
+        except Exception as e:
+            logging.exception("unexpected error in the worker")
+            # Jobs already done keep their state and their attached jobs are ended, so this only fails the stuck ones
+            for job in jobs:
+                queue.fail(job.id, e)
+            attached = queue.fail_attached([job.id for job in jobs], e)
+            if attached:
+                bot.worker_pool.put(deliver, attached)
+        finally:
+            # Jobs already done or failed keep their state, this only closes the ones left running
+            for job in jobs:
+                queue.fail(job.id, "the worker ended the job without a result")
+            attached = queue.fail_attached([job.id for job in jobs], "the job it attached to ended without a result")
+            if attached:
+                bot.worker_pool.put(deliver, attached)
+
+for _ in range(WORKERS):
+    threading.Thread(target=worker, daemon=True).start()
 
-bot.polling(none_stop=True)
+if WEBHOOK_URL:
+    # Only the webhook mode needs aiohttp, long polling runs without it
+    from webhook import run_webhook
+    run_webhook(bot, WEBHOOK_URL, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET or None)
+else:
+    # Telegram refuses getUpdates while a webhook is set
+    bot.remove_webhook()
+    bot.polling(none_stop=True)
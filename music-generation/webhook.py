@@ -0,0 +1,49 @@
+"""
+Webhook front end for the Telegram bot on an asyncio HTTP server.
+
+Long polling fetches updates from one thread with the synchronous client. In webhook mode Telegram
+posts every update to this server instead: aiohttp accepts them on one event loop, checks the
+secret token and hands each update to the bot's handler thread pool, where it is answered and
+queued for generation. The request returns as soon as the update is handed over, so ingestion is
+never held up by replies or generation.
+
+Functions:
+    create_app(bot, path, secret_token): Returns the aiohttp application that receives the updates.
+    run_webhook(bot, url, host, port, path, secret_token): Registers the webhook with Telegram and serves it.
+"""
+import asyncio
+import logging
+
+import telebot
+from aiohttp import web
+
+
+def create_app(bot, path="/webhook", secret_token=None):
+    async def receive(request):
+        if secret_token and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != secret_token:
+            return web.Response(status=403)
+        try:
+            update = telebot.types.Update.de_json(await request.text())
+        except (ValueError, KeyError, TypeError):
+            return web.Response(status=400)
+        # A threaded TeleBot runs the handlers in its worker pool, this only puts the update there
+        bot.process_new_updates([update])
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(path, receive)
+    return app
+
+
+def run_webhook(bot, url, host="0.0.0.0", port=8443, path="/webhook", secret_token=None):
+    app = create_app(bot, path, secret_token)
+
+    async def register(app):
+        webhook_url = url.rstrip("/") + path
+        await asyncio.get_running_loop().run_in_executor(
+            None, lambda: bot.set_webhook(url=webhook_url, secret_token=secret_token)
+        )
+        logging.info(f"webhook registered at {webhook_url}")
+
+    app.on_startup.append(register)
+    web.run_app(app, host=host, port=port, print=None)